@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import sys
+import time
+
+from loader import Dataloader
+from odd import Odd
+from tow import TOW
+from hll import HyperLogLog
+from gxbits import GXBits
+
+
+# metrics where a larger value is better, every other compared metric is better when smaller
+HIGHER_IS_BETTER = ('build_items_per_second', 'estimate_pairs_per_second')
+COMPARED_METRICS = ('build_items_per_second', 'estimate_pairs_per_second', 'bytes_per_sketch', 'peak_rss_kb')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='throughput and memory benchmark of the sketch methods')
+    parser.add_argument('--methods', default='odd,tow,hll,gxbits,gxbits_bt', type=str,
+                        help='comma-separated methods: odd/tow/hll/gxbits/gxbits_bt (block-truncated gxbits)')
+    parser.add_argument('--sizes', default='128,1024', type=str, help='comma-separated sketch sizes')
+    parser.add_argument('--cardinalities', default='100,1000', type=str, help='comma-separated set cardinalities')
+    parser.add_argument('--num_pairs', default=10, type=int, help='the number of synthetic set pairs per dataset')
+    parser.add_argument('--repeats', default=3, type=int, help='the number of timed runs, the median is reported')
+    parser.add_argument('--seed', default=0, type=int, help='random seed of the synthetic datasets and sketches')
+    parser.add_argument('--generator', default='random', type=str,
+                        help='how synthetic items are drawn: random/permutation')
+    parser.add_argument('--workers', default=1, type=int, help='the number of processes used to build sketches')
+    parser.add_argument('--output', default='benchmark.json', type=str, help='path of the json result file')
+    parser.add_argument('--baseline', default=None, type=str, help='json result file to compare against')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='relative change against the baseline reported as a regression')
+
+    parser.add_argument('--tow_construction', default='classic', type=str,
+                        help='how counter signs are drawn: classic/single')
+    parser.add_argument('--hll_sparse', default=0, type=int,
+                        help='whether hyperloglog sketches with few non-zero counters are stored sparsely or not')
+    parser.add_argument('--gxbits_sparse', default=0, type=int,
+                        help='whether gxbits sketches with few one bits are stored sparsely or not')
+    parser.add_argument('--probability', default=0.15, type=float, help='parameter of geometric distribution')
+    parser.add_argument('--num_bits', default=2, type=int, help='the number of bits in each segment')
+    parser.add_argument('--lookup_table', default=0, type=int,
+                        help='whether gxbits estimates are read from a precomputed table or not')
+    parser.add_argument('--solver', default='safeguarded', type=str,
+                        help='root finder for gxbits estimates: safeguarded/damped')
+
+    args = parser.parse_args()
+    return args
+
+
+def create_sketch(method, dict_dataset, size, args):
+    """
+    :param method: odd/tow/hll/gxbits/gxbits_bt
+    :param dict_dataset: dataset represented as a map user->list of items
+    :param size: sketch size
+    :param args: benchmark arguments holding the method-specific parameters
+
+    :output a sketch object whose sketches have not been built yet
+    """
+
+    if method == 'odd':
+        return Odd(dict_dataset, size, None, args.seed)
+    elif method == 'tow':
+        return TOW(dict_dataset, size, None, args.seed, construction=args.tow_construction)
+    elif method == 'hll':
+        return HyperLogLog(dict_dataset, size, None, args.seed, sparse=args.hll_sparse)
+    elif method in ('gxbits', 'gxbits_bt'):
+        return GXBits(dict_dataset, size, args.probability, int(method == 'gxbits_bt'), args.num_bits, 0.01, 0.01,
+                      None, args.seed, args.lookup_table, solver=args.solver, sparse=args.gxbits_sparse)
+    raise ValueError('unknown method: ' + str(method))
+
+
+def get_peak_rss_kb():
+    import resource
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macos and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+
+    return peak_rss
+
+
+def run_case(case):
+    """
+    :param case: (method, size, cardinality, args)
+
+    :output the measurements of one benchmark case, run in a fresh process so that peak_rss_kb only covers it;
+            bytes_per_sketch is the average in-memory size of the sketches in their stored (sparse or dense) form and
+            record_bytes the size of their packed records
+    """
+
+    method, size, cardinality, args = case
+
+    # each set has cardinality items, half of them shared with the other set of its pair
+    dataloader = Dataloader('synthetic', cardinality // 2, cardinality, 0.5, args.seed, generator=args.generator)
+    dict_dataset = dataloader.generate_synthetic_pairs(args.num_pairs)
+    num_items = sum([len(dict_dataset[user]) for user in dict_dataset])
+    lst_pair = [('A' + str(k), 'B' + str(k)) for k in range(args.num_pairs)]
+
+    lst_build_time = list()
+    lst_estimate_time = list()
+    for r in range(args.repeats):
+        sketch = create_sketch(method, dict_dataset, size, args)
+
+        start = time.perf_counter()
+        sketch.build_sketch(args.workers)
+        lst_build_time.append(time.perf_counter() - start)
+
+        dict_sketch = getattr(sketch, 'dict_' + sketch.method + '_sketch')
+        start = time.perf_counter()
+        for user_A, user_B in lst_pair:
+            sketch.estimate_pair(dict_sketch[user_A], dict_sketch[user_B])
+        lst_estimate_time.append(time.perf_counter() - start)
+
+    build_time = sorted(lst_build_time)[len(lst_build_time) // 2]
+    estimate_time = sorted(lst_estimate_time)[len(lst_estimate_time) // 2]
+    # sketches are integers, bytearrays or arrays (sparse forms included), whose sys.getsizeof() covers their content
+    memory = sum([sys.getsizeof(dict_sketch[user]) for user in dict_sketch]) / len(dict_sketch)
+
+    return {'method': method, 'size': size, 'cardinality': cardinality, 'num_sets': len(dict_dataset),
+            'num_items': num_items, 'num_pairs': len(lst_pair),
+            'build_seconds': build_time, 'estimate_seconds': estimate_time,
+            'build_items_per_second': num_items / build_time if build_time > 0 else float('inf'),
+            'estimate_pairs_per_second': len(lst_pair) / estimate_time if estimate_time > 0 else float('inf'),
+            'bytes_per_sketch': memory, 'record_bytes': sketch.record_size, 'peak_rss_kb': get_peak_rss_kb()}
+
+
+def run_case_process(case, connection):
+    connection.send(run_case(case))
+    connection.close()
+
+
+def run_benchmark(args):
+    lst_case = [(method, int(size), int(cardinality), args)
+                for method in args.methods.split(',')
+                for size in args.sizes.split(',')
+                for cardinality in args.cardinalities.split(',')]
+
+    fork = 'fork' in multiprocessing.get_all_start_methods()
+    if not fork:
+        logging.warning('isolated benchmark cases require the fork start method, peak_rss_kb covers all cases so far')
+
+    lst_result = list()
+    for case in lst_case:
+        if fork:
+            # every case runs in its own process, and so gets its own peak resident set size; the process is not a
+            # daemon (unlike pool workers), so build_sketch() can start its own pool when --workers > 1
+            context = multiprocessing.get_context('fork')
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_case_process, args=(case, sender))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                raise RuntimeError('benchmark case ' + str(case[:3]) + ' failed') from None
+            finally:
+                process.join()
+        else:
+            result = run_case(case)
+        print(format_result(result))
+        lst_result.append(result)
+
+    return lst_result
+
+
+def format_result(result):
+    return ('{method:<10} size={size:<6} cardinality={cardinality:<7} build={build_items_per_second:>12.0f} items/s  '
+            'estimate={estimate_pairs_per_second:>10.0f} pairs/s  {bytes_per_sketch:>8.1f} bytes/sketch  '
+            'peak_rss={peak_rss_kb} KB').format(**result)
+
+
+def compare_results(lst_result, lst_baseline, threshold):
+    """
+    :param lst_result: measurements of the current run
+    :param lst_baseline: measurements of the baseline run
+    :param threshold: relative change reported as a regression
+
+    :output list of (method, size, cardinality, metric, baseline value, current value, relative change) for every
+            metric that got worse by more than threshold; cases missing from the baseline are ignored
+    """
+
+    dict_baseline = {(result['method'], result['size'], result['cardinality']): result for result in lst_baseline}
+
+    lst_regression = list()
+    for result in lst_result:
+        key = (result['method'], result['size'], result['cardinality'])
+        if key not in dict_baseline:
+            continue
+
+        for metric in COMPARED_METRICS:
+            baseline_value = dict_baseline[key][metric]
+            value = result[metric]
+            if not baseline_value:
+                continue
+
+            change = (value - baseline_value) / baseline_value
+            print('{:<10} size={:<6} cardinality={:<7} {:<26} {:>14.2f} -> {:>14.2f} ({:+.1%})'.format(
+                key[0], key[1], key[2], metric, baseline_value, value, change))
+            # a positive change of a throughput metric is an improvement
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                lst_regression.append(key + (metric, baseline_value, value, change))
+
+    return lst_regression
+
+
+if __name__ == '__main__':
+    args = get_args()
+    lst_result = run_benchmark(args)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+              'results': lst_result}
+    with open(args.output, 'w') as fwriter:
+        json.dump(report, fwriter, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as freader:
+            baseline = json.load(freader)
+        lst_regression = compare_results(lst_result, baseline['results'], args.threshold)
+        for method, size, cardinality, metric, baseline_value, value, change in lst_regression:
+            print('regression: {} size={} cardinality={} {} worse by {:.1%}'.format(method, size, cardinality,
+                                                                                     metric, change))
+        if lst_regression:
+            sys.exit(1)
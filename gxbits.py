@@ -1,12 +1,29 @@
-import mmh3
 import math
+import heapq
+import operator
 import random
 import os
 import pickle
+import sys
+from array import array
 
+from hashing import hash_user_items
+from parallel import build_sketch_parallel
+from metrics import METRICS
 from utils import *
 
 
+# lookup tables shared by all gxbits instances, keyed by the configuration returned by GXBits.get_solver_key()
+LOOKUP_TABLES = dict()
+
+# memory taken by a python integer besides its digits
+INT_OVERHEAD = sys.getsizeof(1) - sys.int_info.sizeof_digit
+
+# largest estimate of the safeguarded solver, returned for sketches too saturated to have a root so that estimates
+# stay monotone in the number of one bits
+MAX_DIFFERENCE = 2 ** 48
+
+
 class GXBits:
 
     """
@@ -15,114 +32,431 @@ class GXBits:
         :param probability: parameter of the geometric distribution
         :param block_truncated: whether gxbits sketch is block_truncated or not
         :param num_bits: the number of bits in each segment
-        :param num_iterations: maximum number of iterations for newton-raphson method
-        :param error: stopping condition of newton-raphson method
+        :param error: stopping condition of the damped newton-raphson method (bound on the first derivative)
+        :param rate: step rate of the damped newton-raphson method
         :param output: output directory, the default is 'result/'
         :param seed: the round number of experiments, which is also used as the random seed in each round
+        :param lookup_table: whether estimates are read from a precomputed table indexed by the number of one bits
+        :param table_dir: directory where lookup tables are cached on disk, None keeps them in memory only
+        :param solver: root finder used to solve the estimation equation: 'safeguarded' (newton-raphson with a
+                       bisection fallback inside a sign-changing bracket) or 'damped' (the original damped iteration)
+        :param num_iterations: maximum number of iterations for newton-raphson method
+        :param tolerance: stopping condition of the safeguarded solver (bound on the residual of the raw function)
+        :param hash_cache: optional HashCache shared by the sketches built over the same dataset
+        :param sparse: whether sketches with few one bits are stored in sparse form or not
+        :param sparse_threshold: the maximum number of one bits of a sparse sketch, the default stores a sketch in
+                                 sparse form whenever it takes less memory than the python integer
 
         :func build_sketch(): initialize a gxbits sketch for each user and update the sketch based on all its items
-        :func estimate_difference(): estimate the set difference cardinality
-        :func newton_raphson(): iteratively optimize the estimated set difference cardinality
+                              (each dense sketch is packed into a python integer, bit j stores the j-th bit)
+                              (users are sharded across a process pool when workers > 1)
+        :func build_sketch_stream(): build the sketches of a stream of (user, list of items) pairs
+        :func build_user_sketch(): build the gxbits sketch of a single list of items
+                                   (dense sketches are python integers, sparse sketches are sorted arrays of the
+                                   indices of their one bits)
+        :func is_sparse_smaller(): whether a sketch with one_bits one bits, the highest one being bit bit_length - 1,
+                                   is stored in sparse form
+        :func compact_sketch(): convert a dense sketch to sparse form when it has few enough one bits
+        :func to_dense(): convert a sketch to dense form
+        :func count_one_bits(): the number of one bits in A XOR B for any combination of sparse and dense sketches
+        :func compute_indices(): compute the bit flipped by each item from its hash value alone, so sketches do not
+                                 depend on the processing order and can be built in parallel, sharded or updated
+        :func merge_sketch(): merge the sketches of two disjoint sets into the sketch of their union (bitwise XOR)
+        :func add(), remove(): insert an item into or delete an item from the set and the sketch of a user
+        :func apply_batch(): apply a stream of (user, item, +1/-1) events to dict_dataset and the sketches, hashing the
+                             changed items of each user together; returns the net insertions and deletions
+        :func pack_sketch(), unpack_sketch(): convert a sketch to and from a fixed-width record of record_size bytes
+        :func get_params(): parameters that determine the content of the sketches, stored in sketch store headers
+        :func estimate_difference(): estimate the set difference cardinality of shuffled adjacent users, updating
+                                     lst_accumulator and writing the results in result_format ('pickle'/'columnar');
+                                     exact differences come from ground_truth, a GroundTruth shared across methods
+        :func estimate_from_bits(): estimate the set difference cardinality from the number of one bits in A XOR B
+        :func estimate_pair(): estimate the set difference cardinality between two gxbits sketches
+        :func estimate_one_vs_many(): estimate the set difference cardinalities between a query sketch and a list of
+                                      candidate sketches
+        :func estimate_all_pairs(): estimate the matrix of set difference cardinalities within a list of sketches
+        :func top_k(): select the k candidate sketches with the smallest (or largest) estimated set difference
+        :func solve_difference(): solve the estimation equation for a given number of one bits
+        :func build_lookup_table(): solve the estimation equation once for every possible number of one bits
+        :func newton_raphson(): iteratively optimize the estimated set difference cardinality with damped steps
+        :func safeguarded_newton_raphson(): bracket the root of the raw function and optimize the estimated set
+                                            difference cardinality with newton-raphson steps kept inside the bracket
         :func compute_probability(): compute the mapping probability for each bit
+        :func compute_probability_table(): group bits sharing the same mapping probability and cache, for each group,
+                                           the base (1 - 2p), its logarithm and the number of bits in the group
         :func compute_function_derivative(): compute the raw function, first derivative, and second derivative with
                                              respect to the estimated set difference cardinality
 
         :output format: [actual set difference, estimated set difference]
+        :instrumentation: the number of solver iterations of each estimated pair is reported to METRICS as the
+                          'solver_iterations' distribution (a running count, sum, minimum and maximum) when it is enabled
     """
 
-    def __init__(self, dict_dataset, size, probability, block_truncated, num_bits, error, rate, output, seed):
+    def __init__(self, dict_dataset, size, probability, block_truncated, num_bits, error, rate, output, seed,
+                 lookup_table=0, table_dir=None, solver='safeguarded', num_iterations=1000, tolerance=1e-12,
+                 hash_cache=None, sparse=0, sparse_threshold=None):
+        self.method = 'gxbits'
         self.dict_dataset = dict_dataset
         self.size = size
         self.probability = probability
         self.block_truncated = block_truncated
         self.num_bits = num_bits
         self.num_segments = math.ceil(size / num_bits)
+        self.record_size = (size + 7) // 8
         self.error = error
         self.rate = rate
         self.output = output
         self.seed = seed
-
-    def build_sketch(self):
+        self.hash_cache = hash_cache
         self.dict_gxbits_sketch = dict()
+        self.sparse = sparse
+        self.sparse_threshold = sparse_threshold
+        # indices are stored as 16-bit integers whenever they fit
+        self.sparse_typecode = 'H' if size <= 2 ** 16 else 'I'
+        self.sparse_overhead = sys.getsizeof(array(self.sparse_typecode))
+        self.sparse_itemsize = array(self.sparse_typecode).itemsize
+        self.lookup_table = lookup_table
+        self.table_dir = table_dir
+        self.lst_lookup_table = None
+        self.solver = solver
+        self.num_iterations = num_iterations
+        self.tolerance = tolerance
+        self.last_iterations = 0
+        self.compute_probability_table()
+
+    def build_sketch(self, workers=1):
+        if workers > 1:
+            self.dict_gxbits_sketch = build_sketch_parallel(self, workers)
+            return
 
+        self.dict_gxbits_sketch = dict()
         for user in self.dict_dataset:
-            gxbits_sketch = [0] * self.size
-
-            if not self.block_truncated:
-                for item in self.dict_dataset[user]:
-                    random_num = mmh3.hash(str(item), signed=False, seed=self.seed) / (2 ** 32 - 1)
-                    index = math.floor(math.log(1 - random_num) / math.log(1 - self.probability))
-                    if index >= self.size:
-                        index = self.size - 1
-                    gxbits_sketch[index] ^= 1
+            self.dict_gxbits_sketch[user] = self.build_user_sketch(self.dict_dataset[user], user)
 
-                self.dict_gxbits_sketch[user] = gxbits_sketch
+    def build_sketch_stream(self, stream):
+        # stream yields (user, list of items), e.g. Dataloader.iter_public_dataset(), so sketches can be built without
+        # holding the raw dataset in memory
+        self.dict_gxbits_sketch = dict()
+        for user, lst_items in stream:
+            self.dict_gxbits_sketch[user] = self.build_user_sketch(lst_items)
+
+    def build_user_sketch(self, lst_items, user=None):
+        # bit j of the integer is the j-th bit of the gxbits sketch
+        gxbits_sketch = 0
+        lst_hash = hash_user_items(lst_items, self.seed, self.hash_cache, user, self.dict_dataset)
+        for index in self.compute_indices(lst_hash):
+            gxbits_sketch ^= 1 << index
+
+        return self.compact_sketch(gxbits_sketch)
+
+    def is_sparse_smaller(self, one_bits, bit_length):
+        if self.sparse_threshold is not None:
+            return one_bits <= self.sparse_threshold
+
+        # python integers grow with their highest one bit, not with size, so a sketch whose one bits all sit in the
+        # low-index bits is already compact and only sketches with few, spread-out one bits are worth converting
+        num_digits = -(-bit_length // sys.int_info.bits_per_digit)
+        return self.sparse_overhead + self.sparse_itemsize * one_bits < \
+            INT_OVERHEAD + sys.int_info.sizeof_digit * num_digits
+
+    def compact_sketch(self, gxbits_sketch):
+        if not self.sparse or not self.is_sparse_smaller(popcount(gxbits_sketch), gxbits_sketch.bit_length()):
+            return gxbits_sketch
+
+        sparse_sketch = array(self.sparse_typecode)
+        while gxbits_sketch:
+            lowest_bit = gxbits_sketch & -gxbits_sketch
+            sparse_sketch.append(lowest_bit.bit_length() - 1)
+            gxbits_sketch ^= lowest_bit
+
+        return sparse_sketch
+
+    def to_dense(self, gxbits_sketch):
+        if not isinstance(gxbits_sketch, array):
+            return gxbits_sketch
+
+        dense_sketch = 0
+        for index in gxbits_sketch:
+            dense_sketch |= 1 << index
+
+        return dense_sketch
+
+    def count_one_bits(self, gxbits_sketch_A, gxbits_sketch_B):
+        if not isinstance(gxbits_sketch_A, array) and not isinstance(gxbits_sketch_B, array):
+            return popcount(gxbits_sketch_A ^ gxbits_sketch_B)
+
+        if isinstance(gxbits_sketch_A, array) and isinstance(gxbits_sketch_B, array):
+            return len(set(gxbits_sketch_A).symmetric_difference(gxbits_sketch_B))
+
+        # each index of the sparse sketch flips one bit of the dense sketch, adding a one bit if it was zero and
+        # removing it otherwise
+        if isinstance(gxbits_sketch_A, array):
+            gxbits_sketch_A, gxbits_sketch_B = gxbits_sketch_B, gxbits_sketch_A
+        one_bits = popcount(gxbits_sketch_A)
+        for index in gxbits_sketch_B:
+            one_bits += -1 if gxbits_sketch_A >> index & 1 else 1
+
+        return one_bits
+
+    def compute_indices(self, lst_hash):
+        # the index of an item only depends on its hash value: the geometric draw picks the bit (or the segment of a
+        # block-truncated sketch) and, in block-truncated sketches, the low bits of the hash pick the offset inside the
+        # segment, which barely affect the geometric draw
+        log_base = math.log(1 - self.probability)
+        if not self.block_truncated:
+            last_index = self.size - 1
+            return [min(math.floor(math.log(1 - hash_value / (2 ** 32 - 1)) / log_base), last_index)
+                    for hash_value in lst_hash]
+
+        num_bits = self.num_bits
+        last_segment = self.num_segments - 1
+        last_width = self.size - last_segment * num_bits
+        lst_index = list()
+        for hash_value in lst_hash:
+            segment_index = math.floor(math.log(1 - hash_value / (2 ** 32 - 1)) / log_base)
+            if segment_index >= last_segment:
+                lst_index.append(last_segment * num_bits + hash_value % last_width)
             else:
-                for item in self.dict_dataset[user]:
-                    random_num = mmh3.hash(str(item), signed=False, seed=self.seed) / (2 ** 32 - 1)
-                    segment_index = math.floor(math.log(1 - random_num) / math.log(1 - self.probability))
-                    if segment_index >= self.num_segments:
-                        segment_index = self.num_segments - 1
-
-                    if segment_index == self.num_segments - 1:
-                        index = random.randint(segment_index * self.num_bits, self.size-1)
-                        gxbits_sketch[index] ^= 1
-                    else:
-                        index = random.randint(segment_index * self.num_bits, (segment_index + 1) * self.num_bits - 1)
-                        gxbits_sketch[index] ^= 1
-
-                self.dict_gxbits_sketch[user] = gxbits_sketch
-
-    def estimate_difference(self):
+                lst_index.append(segment_index * num_bits + hash_value % num_bits)
+
+        return lst_index
+
+    def add(self, user, item):
+        self.apply_batch([(user, item, '+')])
+
+    def remove(self, user, item):
+        self.apply_batch([(user, item, '-')])
+
+    def apply_batch(self, events):
+        # dict_dataset is updated along with the sketches, and only the items whose membership changed are flipped, so
+        # a duplicate insertion or the deletion of an absent item leaves the sketch as it is; insertions and deletions
+        # flip the same bits, so the changed items of a user collapse into one sketch
+        dict_insert, dict_delete = apply_events(self.dict_dataset, events)
+        for user in set(dict_insert) | set(dict_delete):
+            if self.hash_cache is not None:
+                self.hash_cache.invalidate(self.dict_dataset, user)
+            update_sketch = self.build_user_sketch(dict_insert.get(user, []) + dict_delete.get(user, []))
+            self.dict_gxbits_sketch[user] = self.merge_sketch(self.dict_gxbits_sketch.get(user, 0), update_sketch)
+        METRICS.count('events_applied', sum([len(lst_items) for lst_items in dict_insert.values()]) +
+                      sum([len(lst_items) for lst_items in dict_delete.values()]))
+
+        return dict_insert, dict_delete
+
+    def merge_sketch(self, gxbits_sketch_A, gxbits_sketch_B):
+        if isinstance(gxbits_sketch_A, array) and isinstance(gxbits_sketch_B, array):
+            set_index = set(gxbits_sketch_A).symmetric_difference(gxbits_sketch_B)
+            if not set_index or self.is_sparse_smaller(len(set_index), max(set_index) + 1):
+                return array(self.sparse_typecode, sorted(set_index))
+
+        return self.compact_sketch(self.to_dense(gxbits_sketch_A) ^ self.to_dense(gxbits_sketch_B))
+
+    def pack_sketch(self, gxbits_sketch):
+        return self.to_dense(gxbits_sketch).to_bytes(self.record_size, 'little')
+
+    def unpack_sketch(self, buffer):
+        return self.compact_sketch(int.from_bytes(buffer, 'little'))
+
+    def get_params(self):
+        params = {'method': self.method, 'size': self.size, 'probability': self.probability,
+                  'block_truncated': self.block_truncated, 'num_bits': self.num_bits, 'seed': self.seed,
+                  'record_size': self.record_size}
+        # block-truncated offsets used to be drawn from the global random state, stores of such sketches are rejected
+        if self.block_truncated:
+            params['offset'] = 'hash'
+
+        return params
+
+    def estimate_difference(self, lst_accumulator=None, result_format='pickle', ground_truth=None):
+        if ground_truth is None:
+            ground_truth = GroundTruth(self.dict_dataset)
+
         random.seed(self.seed)
 
         lst_user = list(self.dict_dataset.keys())
         num_user = len(lst_user)
         random.shuffle(lst_user)
+        lst_actual = ground_truth.compute_pairs(list(zip(lst_user, lst_user[1:])))
 
-        lst_result = list()
-        for i in range(num_user - 1):
-            user_A = lst_user[i]
-            user_B = lst_user[i + 1]
+        result_sink = ResultSink(self.output, 'gxbits_' + str(self.seed), result_format, lst_accumulator)
+        # iterations are only aggregated while metrics are enabled, and never kept per pair
+        observe = METRICS.enabled
+        with METRICS.timer('estimate'):
+            for i in range(num_user - 1):
+                user_A = lst_user[i]
+                user_B = lst_user[i + 1]
 
-            lst_A = self.dict_dataset[user_A]
-            lst_B = self.dict_dataset[user_B]
+                gxbits_sketch_A = self.dict_gxbits_sketch[user_A]
+                gxbits_sketch_B = self.dict_gxbits_sketch[user_B]
 
-            gxbits_sketch_A = self.dict_gxbits_sketch[user_A]
-            gxbits_sketch_B = self.dict_gxbits_sketch[user_B]
+                one_bits = self.count_one_bits(gxbits_sketch_A, gxbits_sketch_B)
+                estimated_difference = self.estimate_from_bits(one_bits)
+                if observe:
+                    METRICS.observe('solver_iterations', (self.last_iterations,))
+                actual_difference = lst_actual[i]
 
-            zero_ratio = 0
-            one_bits = 0
-            for j in range(self.size):
-                zero_ratio += (1 - gxbits_sketch_A[j] ^ gxbits_sketch_B[j])
-                one_bits += gxbits_sketch_A[j] ^ gxbits_sketch_B[j]
-            zero_ratio /= self.size
+                result_sink.append(actual_difference, estimated_difference)
+        METRICS.count('pairs_estimated', num_user - 1)
 
-            if one_bits >= self.size / 2:
-                one_bits = self.size / 2 - 1
+        return result_sink.close()
 
-            initial_difference = math.log(1 - 2 * one_bits / self.size) / math.log(1 - 2 / self.size)
-            estimated_difference = self.newton_raphson(initial_difference, zero_ratio)
-            actual_difference = compute_difference(lst_A, lst_B)
+    def estimate_from_bits(self, one_bits):
+        if self.lookup_table:
+            if self.lst_lookup_table is None:
+                self.build_lookup_table()
+            self.last_iterations = 0
+            return self.lst_lookup_table[one_bits]
+
+        return self.solve_difference(one_bits)
+
+    def estimate_pair(self, gxbits_sketch_A, gxbits_sketch_B):
+        return self.estimate_from_bits(self.count_one_bits(gxbits_sketch_A, gxbits_sketch_B))
 
-            lst_result.append([actual_difference, estimated_difference])
+    def estimate_one_vs_many(self, gxbits_sketch, lst_gxbits_sketch):
+        lst_one_bits = [self.count_one_bits(gxbits_sketch, candidate) for candidate in lst_gxbits_sketch]
 
-        foutput = open(os.path.join(self.output, 'gxbits_' + str(self.seed) + '.out'), 'wb')
-        pickle.dump(lst_result, foutput)
-        foutput.close()
+        return self.map_estimates(lst_one_bits)
 
-        return lst_result
+    def estimate_all_pairs(self, lst_gxbits_sketch):
+        num_sketch = len(lst_gxbits_sketch)
+        lst_one_bits = list()
+        for i in range(num_sketch):
+            gxbits_sketch = lst_gxbits_sketch[i]
+            lst_one_bits.extend(self.count_one_bits(gxbits_sketch, lst_gxbits_sketch[j])
+                                for j in range(i + 1, num_sketch))
+        lst_estimate = self.map_estimates(lst_one_bits)
+
+        diagonal = self.estimate_from_bits(0)
+        matrix = [[diagonal] * num_sketch for _ in range(num_sketch)]
+        k = 0
+        for i in range(num_sketch):
+            for j in range(i + 1, num_sketch):
+                matrix[i][j] = matrix[j][i] = lst_estimate[k]
+                k += 1
+
+        return matrix
+
+    def top_k(self, gxbits_sketch, lst_gxbits_sketch, k, largest=False):
+        # the estimate grows with the number of one bits in A XOR B, so candidates are ranked by their popcount and
+        # only the k selected ones are mapped to estimates; returns [(candidate position, estimated difference)]
+        select = heapq.nlargest if largest else heapq.nsmallest
+        lst_top = select(k, ((self.count_one_bits(gxbits_sketch, candidate), i)
+                             for i, candidate in enumerate(lst_gxbits_sketch)))
+
+        return [(i, self.estimate_from_bits(one_bits)) for one_bits, i in lst_top]
+
+    def map_estimates(self, lst_one_bits):
+        # candidates sharing the same number of one bits share the same estimate, so each count is solved once
+        dict_estimate = {one_bits: self.estimate_from_bits(one_bits) for one_bits in set(lst_one_bits)}
+
+        return [dict_estimate[one_bits] for one_bits in lst_one_bits]
+
+    def solve_difference(self, one_bits):
+        zero_ratio = (self.size - one_bits) / self.size
+
+        if one_bits >= self.size / 2:
+            one_bits = self.size / 2 - 1
+
+        initial_difference = math.log(1 - 2 * one_bits / self.size) / math.log(1 - 2 / self.size)
+        if self.solver == 'damped':
+            estimated_difference = self.newton_raphson(initial_difference, zero_ratio)
+        elif self.solver == 'safeguarded':
+            estimated_difference = self.safeguarded_newton_raphson(initial_difference, zero_ratio)
+        else:
+            raise ValueError('unknown solver: ' + str(self.solver))
+
+        return estimated_difference
+
+    def build_lookup_table(self):
+        # the estimate only depends on the number of one bits in A XOR B, so there are size + 1 possible answers
+        # for a given configuration; tables are shared in memory across instances and optionally cached on disk
+        key = self.get_solver_key()
+        if key in LOOKUP_TABLES:
+            self.lst_lookup_table = LOOKUP_TABLES[key]
+            return
+
+        path = None
+        if self.table_dir is not None:
+            path = os.path.join(self.table_dir, 'gxbits_table_' + '_'.join(map(str, key)) + '.pkl')
+
+        if path is not None and os.path.exists(path):
+            freader = open(path, 'rb')
+            lst_lookup_table = pickle.load(freader)
+            freader.close()
+        else:
+            with METRICS.timer('lookup_table'):
+                lst_lookup_table = [self.solve_difference(one_bits) for one_bits in range(self.size + 1)]
+            if path is not None:
+                os.makedirs(self.table_dir, exist_ok=True)
+                foutput = open(path, 'wb')
+                pickle.dump(lst_lookup_table, foutput)
+                foutput.close()
+
+        LOOKUP_TABLES[key] = lst_lookup_table
+        self.lst_lookup_table = lst_lookup_table
+
+    def get_solver_key(self):
+        key = (self.size, self.probability, self.block_truncated, self.num_bits, self.solver, self.num_iterations)
+        if self.solver == 'damped':
+            return key + (self.error, self.rate)
+        else:
+            return key + (self.tolerance,)
 
     def newton_raphson(self, initial_difference, zero_ratio):
         estimated_difference = initial_difference
         raw_function, first_derivative = self.compute_function_derivative(estimated_difference, zero_ratio)
 
-        while abs(first_derivative) > self.error:
+        iterations = 0
+        while abs(first_derivative) > self.error and iterations < self.num_iterations:
             estimated_difference -= self.rate * raw_function / first_derivative
             raw_function, first_derivative = self.compute_function_derivative(estimated_difference, zero_ratio)
+            iterations += 1
 
+        self.last_iterations = iterations
         return estimated_difference
 
+    def safeguarded_newton_raphson(self, initial_difference, zero_ratio):
+        # the raw function decreases with the estimated difference and is non-negative at 0, so the root is
+        # bracketed by [0, upper] as soon as the raw function at upper becomes non-positive
+        lower = 0
+        upper = max(initial_difference, 1)
+        iterations = 0
+
+        raw_function, first_derivative = self.compute_function_derivative(upper, zero_ratio)
+        while raw_function > 0 and upper < MAX_DIFFERENCE and iterations < self.num_iterations:
+            lower = upper
+            upper *= 2
+            raw_function, first_derivative = self.compute_function_derivative(upper, zero_ratio)
+            iterations += 1
+
+        if raw_function > 0:
+            # saturated sketches: the expected zero ratio never drops to the observed one
+            self.last_iterations = iterations
+            return MAX_DIFFERENCE
+
+        estimated_difference = min(max(initial_difference, lower), upper)
+        while iterations < self.num_iterations:
+            raw_function, first_derivative = self.compute_function_derivative(estimated_difference, zero_ratio)
+            iterations += 1
+            if abs(raw_function) <= self.tolerance:
+                break
+
+            if raw_function > 0:
+                lower = estimated_difference
+            else:
+                upper = estimated_difference
+            if upper - lower <= self.tolerance * max(1, upper):
+                break
+
+            # fall back to bisection whenever the newton-raphson step leaves the bracket
+            if first_derivative != 0:
+                estimated_difference -= raw_function / first_derivative
+            if first_derivative == 0 or not lower < estimated_difference < upper:
+                estimated_difference = (lower + upper) / 2
+
+        self.last_iterations = iterations
+        # the last doubling may overshoot MAX_DIFFERENCE, roots beyond it are capped like saturated sketches
+        return min(estimated_difference, MAX_DIFFERENCE)
+
     def compute_probability(self, index):
         if not self.block_truncated:
             if 0 <= index <= self.size - 2:
@@ -135,16 +469,27 @@ class GXBits:
             elif self.num_bits * (self.num_segments - 1) <= index <= self.size - 1:
                 return (1 - self.probability) ** (self.num_segments - 1) / self.num_bits
 
-    def compute_function_derivative(self, estimated_difference, zero_ratio):
-        raw_function = 0
-        first_derivative = 0
-        second_derivative = 0
-
+    def compute_probability_table(self):
+        # the block-truncated layout only has num_segments distinct probabilities, and in the plain layout the tail
+        # bits collapse to the same base once 2p underflows, so each group is evaluated once with its multiplicity
+        dict_multiplicity = dict()
         for i in range(self.size):
-            probability = self.compute_probability(i)
-            raw_function += 1 + (1 - 2 * probability) ** estimated_difference
-            first_derivative += math.log(1 - 2 * probability) * (1 - 2 * probability) ** estimated_difference
-            # second_derivative += (math.log(1 - 2 * probability) ** 2) * (1 - 2 * probability) ** estimated_difference
+            base = 1 - 2 * self.compute_probability(i)
+            dict_multiplicity[base] = dict_multiplicity.get(base, 0) + 1
+
+        self.lst_base = list(dict_multiplicity.keys())
+        self.lst_log_base = [math.log(base) for base in self.lst_base]
+        self.lst_multiplicity = list(dict_multiplicity.values())
+
+    def compute_function_derivative(self, estimated_difference, zero_ratio):
+        # each bit i contributes 1 + (1 - 2p_i)^d to the raw function and log(1 - 2p_i) * (1 - 2p_i)^d to the first
+        # derivative, so the constant part is size and the rest is a weighted sum over the probability groups
+        lst_power = [multiplicity * base ** estimated_difference
+                     for base, multiplicity in zip(self.lst_base, self.lst_multiplicity)]
+
+        raw_function = self.size + sum(lst_power)
+        first_derivative = sum(map(operator.mul, self.lst_log_base, lst_power))
+        # second_derivative = sum(map(operator.mul, [x ** 2 for x in self.lst_log_base], lst_power))
 
         raw_function = raw_function / (2 * self.size) - zero_ratio
         first_derivative /= (2 * self.size)
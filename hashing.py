@@ -0,0 +1,109 @@
+import mmh3
+from array import array
+
+from metrics import METRICS
+
+
+def hash_items(lst_items, seed):
+    """
+    :param lst_items: items of one set
+    :param seed: seed of the hash function
+
+    :output array of unsigned 32-bit hash values, one per item, equal to mmh3.hash(str(item), signed=False, seed=seed)
+    """
+
+    # hashing the decimal string is faster in cpython than hashing int.to_bytes(), and keeps the sketches identical
+    # to the ones built item by item
+    hash_function = mmh3.hash
+    METRICS.count('items_hashed', len(lst_items))
+    with METRICS.timer('hash'):
+        return array('I', [hash_function(str(item), seed, False) for item in lst_items])
+
+
+def hash_item_masks(lst_items, seed, num_bits):
+    """
+    :param lst_items: items of one set
+    :param seed: seed of the first hash function
+    :param num_bits: the number of random bits drawn for each item
+
+    :output list of num_bits-bit integers, one per item, obtained by concatenating 128-bit hash values seeded with
+            seed, seed + 1, ...
+    """
+
+    num_hashes = -(-num_bits // 128)
+    mask = (1 << num_bits) - 1
+    hash_function = mmh3.hash128
+
+    METRICS.count('items_hashed', len(lst_items))
+    lst_mask = list()
+    for item in lst_items:
+        key = str(item)
+        bits = 0
+        for k in range(num_hashes):
+            bits |= hash_function(key, seed=seed + k, signed=False) << (128 * k)
+        lst_mask.append(bits & mask)
+
+    return lst_mask
+
+
+class HashCache:
+
+    """
+        :func get(): return the hash values of the items of a user of a dataset, hashing them only on the first request
+        :func prepare(): hash the items of every user of a dataset ahead of time, e.g. before forking workers
+        :func invalidate(): drop the hash values of a user whose items changed
+        :func clear(): drop all hash values
+
+        :output: a cache of hash values keyed by (dataset, user, seed), the dataset being identified by the object
+                 holding it; one cache is meant to be shared by all sketches built over the same datasets, so building
+                 several sketch types or sizes hashes each item only once
+    """
+
+    def __init__(self):
+        self.dict_hash = dict()
+        # the datasets are referenced so that their ids are not reused while their hash values are cached
+        self.dict_dataset = dict()
+
+    def get(self, dict_dataset, user, lst_items, seed):
+        key = (id(dict_dataset), user)
+        dict_seed = self.dict_hash.get(key)
+        if dict_seed is None:
+            self.dict_dataset[id(dict_dataset)] = dict_dataset
+            dict_seed = self.dict_hash[key] = dict()
+
+        hash_values = dict_seed.get(seed)
+        if hash_values is None:
+            hash_values = dict_seed[seed] = hash_items(lst_items, seed)
+        else:
+            METRICS.count('hash_cache_hits')
+
+        return hash_values
+
+    def prepare(self, dict_dataset, seed):
+        for user in dict_dataset:
+            self.get(dict_dataset, user, dict_dataset[user], seed)
+
+    def invalidate(self, dict_dataset, user):
+        self.dict_hash.pop((id(dict_dataset), user), None)
+
+    def clear(self):
+        self.dict_hash.clear()
+        self.dict_dataset.clear()
+
+
+def hash_user_items(lst_items, seed, hash_cache=None, user=None, dict_dataset=None):
+    """
+    :param lst_items: items of one set
+    :param seed: seed of the hash function
+    :param hash_cache: optional HashCache shared by the sketches built over the same dataset
+    :param user: the user owning the items
+    :param dict_dataset: the dataset lst_items was read from (lst_items must be dict_dataset[user]); hash values are
+                         only looked up in hash_cache when both user and dict_dataset are given
+
+    :output array of unsigned 32-bit hash values, one per item
+    """
+
+    if hash_cache is None or user is None or dict_dataset is None:
+        return hash_items(lst_items, seed)
+
+    return hash_cache.get(dict_dataset, user, lst_items, seed)
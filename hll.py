@@ -1,12 +1,17 @@
-import mmh3
 import math
 import random
-import os
-import pickle
+from array import array
 
+from hashing import hash_user_items
+from parallel import build_sketch_parallel
+from metrics import METRICS
 from utils import *
 
 
+# 2 ** -k for every possible counter value, so that cardinality estimation is a table lookup per counter
+INVERSE_POWERS = [2.0 ** -k for k in range(64)]
+
+
 class HyperLogLog:
 
     """
@@ -14,95 +19,173 @@ class HyperLogLog:
         :param size: the number of counters in each hyperloglog sketch
         :param output: output directory, the default is 'result/'
         :param seed: the round number of experiments, which is also used as the random seed in each round
+        :param hash_cache: optional HashCache shared by the sketches built over the same dataset
+        :param sparse: whether sketches with few non-zero counters are stored in sparse form or not
+        :param sparse_threshold: the maximum number of non-zero counters of a sparse sketch, the default is size / 4
 
         :func build_sketch(): initialize a hyperloglog sketch for each user and update the sketch based on all its items
-        :func estimate_difference(): estimate the set difference cardinality
+                              (users are sharded across a process pool when workers > 1)
+        :func build_sketch_stream(): build the sketches of a stream of (user, list of items) pairs
+        :func build_user_sketch(): build the hyperloglog sketch of a single list of items
+                                   (dense sketches are bytearrays with one counter per byte, sparse sketches are sorted
+                                   arrays of (index << 6 | value) entries for the non-zero counters only)
+        :func compact_sketch(): convert a dense sketch to sparse form when it has few enough non-zero counters
+        :func to_dense(): convert a sketch to dense form
+        :func merge_sketch(): merge two sketches by taking the maximum of each counter
+        :func pack_sketch(), unpack_sketch(): convert a sketch to and from a fixed-width record of record_size bytes
+        :func get_params(): parameters that determine the content of the sketches, stored in sketch store headers
+        :func estimate_difference(): estimate the set difference cardinality of shuffled adjacent users, updating
+                                     lst_accumulator and writing the results in result_format ('pickle'/'columnar');
+                                     exact differences come from ground_truth, a GroundTruth shared across methods
+        :func estimate_pair(): estimate the set difference cardinality between two hyperloglog sketches
         :func compute_index_value(): compute the index and counter value for each item before inserting it into the sketch
         :func estimate_cardinality(): estimate the cardinality for each hyperloglog sketch
 
         :output format: [actual set difference, estimated set difference]
     """
 
-    def __init__(self, dict_dataset, size, output, seed):
+    def __init__(self, dict_dataset, size, output, seed, hash_cache=None, sparse=0, sparse_threshold=None):
+        self.method = 'hll'
         self.dict_dataset = dict_dataset
         self.size = size
+        self.flag = math.ceil(math.log2(size))
+        self.alpha = 0.7213 / (1 + 1.079 / size)
+        # counters never exceed 33, so each of them is packed into one byte
+        self.record_size = size
         self.output = output
         self.seed = seed
+        self.hash_cache = hash_cache
+        self.sparse = sparse
+        self.sparse_threshold = size // 4 if sparse_threshold is None else sparse_threshold
 
-    def build_sketch(self):
-        self.dict_hll_sketch = dict()
+    def build_sketch(self, workers=1):
+        if workers > 1:
+            self.dict_hll_sketch = build_sketch_parallel(self, workers)
+            return
 
+        self.dict_hll_sketch = dict()
         for user in self.dict_dataset:
-            hll_sketch = [0] * self.size
-            flag = math.ceil(math.log2(self.size))
+            self.dict_hll_sketch[user] = self.build_user_sketch(self.dict_dataset[user], user)
+
+    def build_sketch_stream(self, stream):
+        # stream yields (user, list of items), e.g. Dataloader.iter_public_dataset(), so sketches can be built without
+        # holding the raw dataset in memory
+        self.dict_hll_sketch = dict()
+        for user, lst_items in stream:
+            self.dict_hll_sketch[user] = self.build_user_sketch(lst_items)
+
+    def build_user_sketch(self, lst_items, user=None):
+        hll_sketch = bytearray(self.size)
+
+        for item_trans in hash_user_items(lst_items, self.seed, self.hash_cache, user, self.dict_dataset):
+            index, value = self.compute_index_value(item_trans, self.flag)
+            if value > hll_sketch[index]:
+                hll_sketch[index] = value
+
+        return self.compact_sketch(hll_sketch)
+
+    def compact_sketch(self, hll_sketch):
+        if not self.sparse or self.size - hll_sketch.count(0) > self.sparse_threshold:
+            return hll_sketch
+
+        return array('I', [index << 6 | value for index, value in enumerate(hll_sketch) if value])
 
-            for item in self.dict_dataset[user]:
-                item_trans = mmh3.hash(str(item), signed=False, seed=self.seed)
-                index, value = self.compute_index_value(item_trans, flag)
-                if value > hll_sketch[index]:
-                    hll_sketch[index] = value
+    def to_dense(self, hll_sketch):
+        if not isinstance(hll_sketch, array):
+            return hll_sketch
 
-            self.dict_hll_sketch[user] = hll_sketch
+        hll_sketch_dense = bytearray(self.size)
+        for entry in hll_sketch:
+            hll_sketch_dense[entry >> 6] = entry & 63
+
+        return hll_sketch_dense
+
+    def merge_sketch(self, hll_sketch_A, hll_sketch_B):
+        if isinstance(hll_sketch_A, array) and isinstance(hll_sketch_B, array):
+            dict_counter = {entry >> 6: entry & 63 for entry in hll_sketch_A}
+            for entry in hll_sketch_B:
+                index = entry >> 6
+                if entry & 63 > dict_counter.get(index, 0):
+                    dict_counter[index] = entry & 63
+
+            if len(dict_counter) <= self.sparse_threshold:
+                return array('I', [index << 6 | dict_counter[index] for index in sorted(dict_counter)])
+            return self.to_dense(array('I', [index << 6 | value for index, value in dict_counter.items()]))
+
+        if isinstance(hll_sketch_A, array):
+            hll_sketch_A, hll_sketch_B = hll_sketch_B, hll_sketch_A
+        if isinstance(hll_sketch_B, array):
+            hll_sketch_merge = bytearray(hll_sketch_A)
+            for entry in hll_sketch_B:
+                if entry & 63 > hll_sketch_merge[entry >> 6]:
+                    hll_sketch_merge[entry >> 6] = entry & 63
+            return hll_sketch_merge
+
+        return bytearray(map(max, hll_sketch_A, hll_sketch_B))
+
+    def pack_sketch(self, hll_sketch):
+        return bytes(self.to_dense(hll_sketch))
+
+    def unpack_sketch(self, buffer):
+        return self.compact_sketch(bytearray(buffer))
+
+    def get_params(self):
+        return {'method': self.method, 'size': self.size, 'seed': self.seed, 'record_size': self.record_size}
 
     def compute_index_value(self, item, flag):
-        binary_item = '0' * (32 - len(bin(item)[2:])) + bin(item)[2:]
-        index = int(binary_item[0:flag], 2) % self.size
-        value = 0
-        for bit in binary_item[flag:]:
-            if bit == '0':
-                value += 1
-            else:
-                break
-        value += 1
+        # the first flag bits of the 32-bit hash select the counter, and the value is one plus the number of leading
+        # zeros of the remaining 32 - flag bits
+        num_rest_bits = 32 - flag
+        index = (item >> num_rest_bits) % self.size
+        value = num_rest_bits - (item & ((1 << num_rest_bits) - 1)).bit_length() + 1
 
         return index, value
 
-    def estimate_difference(self):
+    def estimate_difference(self, lst_accumulator=None, result_format='pickle', ground_truth=None):
+        if ground_truth is None:
+            ground_truth = GroundTruth(self.dict_dataset)
+
         random.seed(self.seed)
 
         lst_user = list(self.dict_dataset.keys())
         num_user = len(lst_user)
         random.shuffle(lst_user)
+        lst_actual = ground_truth.compute_pairs(list(zip(lst_user, lst_user[1:])))
 
-        lst_result = list()
-        for i in range(num_user - 1):
-            user_A = lst_user[i]
-            user_B = lst_user[i + 1]
-
-            lst_A = self.dict_dataset[user_A]
-            lst_B = self.dict_dataset[user_B]
+        result_sink = ResultSink(self.output, 'hll_' + str(self.seed), result_format, lst_accumulator)
+        with METRICS.timer('estimate'):
+            for i in range(num_user - 1):
+                user_A = lst_user[i]
+                user_B = lst_user[i + 1]
 
-            hll_sketch_A = self.dict_hll_sketch[user_A]
-            hll_sketch_B = self.dict_hll_sketch[user_B]
+                hll_sketch_A = self.dict_hll_sketch[user_A]
+                hll_sketch_B = self.dict_hll_sketch[user_B]
 
-            hll_sketch_merge = [0] * self.size
-            for j in range(self.size):
-                hll_sketch_merge[j] = max(hll_sketch_A[j], hll_sketch_B[j])
+                estimated_difference = self.estimate_pair(hll_sketch_A, hll_sketch_B)
+                actual_difference = lst_actual[i]
+                result_sink.append(actual_difference, estimated_difference)
+        METRICS.count('pairs_estimated', num_user - 1)
 
-            cardinality_A = self.estimate_cardinality(hll_sketch_A)
-            cardinality_B = self.estimate_cardinality(hll_sketch_B)
-            cardinality_union = self.estimate_cardinality(hll_sketch_merge)
+        return result_sink.close()
 
-            estimated_difference = abs(2 * cardinality_union - cardinality_A - cardinality_B)
-            actual_difference = compute_difference(lst_A, lst_B)
-            lst_result.append([actual_difference, estimated_difference])
+    def estimate_pair(self, hll_sketch_A, hll_sketch_B):
+        hll_sketch_merge = self.merge_sketch(hll_sketch_A, hll_sketch_B)
 
-        foutput = open(os.path.join(self.output, 'hll_' + str(self.seed) + '.out'), 'wb')
-        pickle.dump(lst_result, foutput)
-        foutput.close()
+        cardinality_A = self.estimate_cardinality(hll_sketch_A)
+        cardinality_B = self.estimate_cardinality(hll_sketch_B)
+        cardinality_union = self.estimate_cardinality(hll_sketch_merge)
 
-        return lst_result
+        return abs(2 * cardinality_union - cardinality_A - cardinality_B)
 
     def estimate_cardinality(self, hll_sketch):
-        zero_bits = 0
-        alpha = 0.7213 / (1 + 1.079 / self.size)
-        tmp = 0
-
-        for i in range(self.size):
-            tmp += (2 ** (-hll_sketch[i]))
-            if hll_sketch[i] == 0:
-                zero_bits += 1
-        cardinality = alpha * (self.size ** 2) / tmp
+        if isinstance(hll_sketch, array):
+            # every counter missing from a sparse sketch is zero and contributes 2 ** 0
+            zero_bits = self.size - len(hll_sketch)
+            tmp = zero_bits + sum([INVERSE_POWERS[entry & 63] for entry in hll_sketch])
+        else:
+            zero_bits = hll_sketch.count(0)
+            tmp = sum(map(INVERSE_POWERS.__getitem__, hll_sketch))
+        cardinality = self.alpha * (self.size ** 2) / tmp
 
         if zero_bits == 0:
             zero_bits = 1
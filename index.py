@@ -0,0 +1,168 @@
+class SketchIndex:
+
+    """
+        :param sketch: Odd or GXBits object whose sketches (python integers, bit j stores the j-th bit) are indexed
+        :param num_bands: the number of bands the bits are split into
+        :param min_width: the minimum number of bits in a band, so that unrelated sketches rarely share a band by chance
+
+        :func compute_bands(): split the bits into at most num_bands contiguous bands of equal probability mass, so
+                               that each band is equally likely to be changed by one item of the set difference
+                               (bands narrower than min_width are merged with the next one)
+        :func get_keys(): the value of every band of a sketch
+        :func score(): estimate the set difference between the query sketch and a list of indexed users
+        :func add(): index the sketch of a user
+        :func remove(): drop a user from the index
+        :func build(): index a map user->sketch, e.g. sketch.dict_gxbits_sketch or a SketchStore.load()
+        :func candidates(): users sharing at least one non-zero band with the query sketch
+        :func query_threshold(): users whose estimated set difference with the query sketch is at most threshold
+        :func query_top_k(): the k users with the smallest estimated set difference with the query sketch
+        :func brute_force_threshold(), brute_force_top_k(): the same queries scoring every indexed user
+        :func recall(): recall of the indexed queries against brute force, and the average fraction of indexed users
+                        scored per query
+
+        :output format: [(user, estimated set difference)] sorted by estimated set difference
+    """
+
+    def __init__(self, sketch, num_bands=16, min_width=16):
+        self.sketch = sketch
+        self.num_bands = num_bands
+        self.min_width = min_width
+        self.dict_sketch = dict()
+        self.compute_bands()
+        self.lst_bucket = [dict() for _ in self.lst_band]
+
+    def compute_bands(self):
+        # an odd sketch maps items uniformly, while a gxbits sketch concentrates them in its low-index bits, so the
+        # gxbits bands are narrow at the start of the sketch and wide in its tail
+        size = self.sketch.size
+        if self.sketch.method == 'gxbits':
+            lst_probability = [self.sketch.compute_probability(j) for j in range(size)]
+        elif self.sketch.method == 'odd':
+            lst_probability = [1 / size] * size
+        else:
+            raise ValueError('sketch indexes only support odd and gxbits sketches, not ' + str(self.sketch.method))
+
+        # a band ends at the first bit where the cumulative mass reaches its share and the band is min_width bits wide;
+        # bands that would be too narrow (e.g. at the start of a gxbits sketch) absorb several shares, leaving fewer
+        # bands
+        total = sum(lst_probability)
+        lst_end = list()
+        mass = 0
+        k = 1
+        for j in range(size):
+            mass += lst_probability[j]
+            while k < self.num_bands and mass >= total * k / self.num_bands:
+                if j + 1 - (lst_end[-1] if lst_end else 0) < self.min_width:
+                    break
+                if size - j - 1 >= self.min_width:
+                    lst_end.append(j + 1)
+                k += 1
+        lst_end.append(size)
+
+        self.lst_band = list()
+        start = 0
+        for end in lst_end:
+            self.lst_band.append((start, (1 << (end - start)) - 1))
+            start = end
+
+    def get_keys(self, sketch_bits):
+        # sparse gxbits sketches are banded through their dense form
+        if self.sketch.method == 'gxbits':
+            sketch_bits = self.sketch.to_dense(sketch_bits)
+
+        return [(sketch_bits >> start) & mask for start, mask in self.lst_band]
+
+    def add(self, user, sketch_bits):
+        if user in self.dict_sketch:
+            self.remove(user)
+
+        self.dict_sketch[user] = sketch_bits
+        # an all-zero band is shared by most sketches in the sparse tail of a gxbits sketch and says nothing about the
+        # set, so it is not bucketed
+        for bucket, key in zip(self.lst_bucket, self.get_keys(sketch_bits)):
+            if key:
+                bucket.setdefault(key, set()).add(user)
+
+    def remove(self, user):
+        sketch_bits = self.dict_sketch.pop(user)
+        for bucket, key in zip(self.lst_bucket, self.get_keys(sketch_bits)):
+            if key:
+                bucket[key].discard(user)
+                if not bucket[key]:
+                    del bucket[key]
+
+    def build(self, dict_sketch):
+        for user in dict_sketch:
+            self.add(user, dict_sketch[user])
+
+    def candidates(self, sketch_bits):
+        set_candidate = set()
+        for bucket, key in zip(self.lst_bucket, self.get_keys(sketch_bits)):
+            set_candidate.update(bucket.get(key, ()))
+
+        return set_candidate
+
+    def score(self, sketch_bits, lst_user):
+        lst_estimate = self.sketch.estimate_one_vs_many(sketch_bits, [self.dict_sketch[user] for user in lst_user])
+
+        return sorted(zip(lst_user, lst_estimate), key=lambda result: result[1])
+
+    def query_threshold(self, sketch_bits, threshold, exclude=None):
+        lst_user = [user for user in self.candidates(sketch_bits) if user != exclude]
+
+        return [result for result in self.score(sketch_bits, lst_user) if result[1] <= threshold]
+
+    def query_top_k(self, sketch_bits, k, exclude=None):
+        lst_user = [user for user in self.candidates(sketch_bits) if user != exclude]
+        # too few candidates to fill the answer, fall back to scoring every indexed user
+        if len(lst_user) < k:
+            return self.brute_force_top_k(sketch_bits, k, exclude)
+
+        lst_sketch = [self.dict_sketch[user] for user in lst_user]
+
+        return [(lst_user[i], estimate) for i, estimate in self.sketch.top_k(sketch_bits, lst_sketch, k)]
+
+    def brute_force_threshold(self, sketch_bits, threshold, exclude=None):
+        lst_user = [user for user in self.dict_sketch if user != exclude]
+
+        return [result for result in self.score(sketch_bits, lst_user) if result[1] <= threshold]
+
+    def brute_force_top_k(self, sketch_bits, k, exclude=None):
+        lst_user = [user for user in self.dict_sketch if user != exclude]
+        lst_sketch = [self.dict_sketch[user] for user in lst_user]
+
+        return [(lst_user[i], estimate) for i, estimate in self.sketch.top_k(sketch_bits, lst_sketch, k)]
+
+    def recall(self, lst_query_user, threshold=None, k=None):
+        """
+        :param lst_query_user: indexed users used as queries, each one is excluded from its own answer
+        :param threshold: evaluate query_threshold() with this threshold
+        :param k: evaluate query_top_k() with this k (when threshold is None)
+
+        :output map with the recall of the indexed answers against the brute-force answers and the average fraction
+                of indexed users that are candidates of a query
+        """
+
+        num_found = 0
+        num_expected = 0
+        num_candidate = 0
+        for user in lst_query_user:
+            sketch_bits = self.dict_sketch[user]
+            if threshold is not None:
+                set_result = set(result[0] for result in self.query_threshold(sketch_bits, threshold, user))
+                set_expected = set(result[0] for result in self.brute_force_threshold(sketch_bits, threshold, user))
+                num_found += len(set_result & set_expected)
+                num_expected += len(set_expected)
+            else:
+                # ties at the k-th smallest estimate make the brute-force answer ambiguous, so every returned user
+                # whose estimate is within the k-th smallest one is a correct answer
+                lst_expected = self.brute_force_top_k(sketch_bits, k, user)
+                if lst_expected:
+                    bound = lst_expected[-1][1]
+                    num_found += len([1 for result in self.query_top_k(sketch_bits, k, user) if result[1] <= bound])
+                num_expected += len(lst_expected)
+            num_candidate += len(self.candidates(sketch_bits) - {user})
+
+        num_other = max(1, len(self.dict_sketch) - 1)
+        return {'recall': num_found / num_expected if num_expected else 1.0,
+                'candidate_ratio': num_candidate / (num_other * max(1, len(lst_query_user)))}
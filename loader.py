@@ -1,5 +1,27 @@
 import logging
+import os
 import random
+from array import array
+from collections.abc import Mapping
+from itertools import islice
+
+
+def permute_index(index, key):
+    """
+    :param index: integer in [0, 2 ** 32)
+    :param key: integer in [0, 2 ** 32) selecting the permutation
+
+    :output the image of index under a bijection of [0, 2 ** 32) (every step below is invertible modulo 2 ** 32)
+    """
+
+    x = (index + key) & 0xffffffff
+    x ^= x >> 16
+    x = (x * 0x7feb352d) & 0xffffffff
+    x ^= x >> 15
+    x = (x * 0x846ca68b) & 0xffffffff
+    x ^= x >> 16
+
+    return x
 
 
 class Dataloader:
@@ -9,66 +31,238 @@ class Dataloader:
         :param difference: set difference cardinality
         :param ratio: used to control cardinalities of two sets
         :param seed: random seed used to generate items in each set
+        :param csr: whether public-available datasets are loaded into a compact CSRDataset or not
+        :param chunk_size: the number of bytes read from the dataset file at a time
+        :param generator: how distinct synthetic items are drawn: 'random' (rejection sampling of random integers) or
+                          'permutation' (a seeded bijective permutation of the 32-bit integers, faster)
 
         :func generate_synthetic_dataset(): generate synthetic dataset
+        :func generate_synthetic_pairs(): generate num_pairs disjoint synthetic set pairs 'A<k>'/'B<k>'
+        :func generate_synthetic_corpus(): generate num_users sets over a universe of num_items items
+        :func iter_distinct_items(): yield distinct synthetic items
         :func load_public_dataset(): load public-available dataset
+        :func load_csr_dataset(): load public-available dataset grouped by user into a CSRDataset
+        :func iter_public_dataset(): yield (user, list of items) for each user of a dataset grouped by user
+        :func iter_edge_chunks(): yield the edges of each chunk of the dataset file (or of its byte range
+                                  [start, end)) as a flat list [user, item, ...]
+        :func get_line_ranges(): split the dataset file into byte ranges that start and end at line boundaries
+        :func parse_edges(): parse complete lines of the dataset file, checking that each line holds one edge
+        :func get_fingerprint(): identify the dataset without reading it (generator parameters of synthetic datasets,
+                                 path, size and modification time of dataset files), e.g. for sketch store headers
 
         :output: dict_dataset: dataset represented as a map user->list of items
     '''
-    def __init__(self, dataset, intersection, difference, ratio, seed):
+    def __init__(self, dataset, intersection, difference, ratio, seed, csr=0, chunk_size=2 ** 24, generator='random'):
         self.dataset = dataset
         self.intersection = intersection
         self.difference = difference
         self.ratio = ratio
         self.seed = seed
+        self.csr = csr
+        self.chunk_size = chunk_size
+        self.generator = generator
 
     def generate_synthetic_dataset(self):
         dict_dataset = dict()
-        lst_union = list()
-        lst_A = list()
-        lst_B = list()
         random.seed(self.seed)
 
-        # fast generate synthetic datasets, but not recommended
-        # random_num = random.randint(0, 2 ** 16)
-        # random_step = random.randint(1, 10)
-        # while len(lst_union) < self.intersection + self.difference:
-        #     lst_union.append(random_num)
-        #     random_num += random_step
+        lst_union = list(islice(self.iter_distinct_items(), self.intersection + self.difference))
+        dict_dataset['A'], dict_dataset['B'] = self.split_union(lst_union)
+
+        return dict_dataset
+
+    def generate_synthetic_pairs(self, num_pairs):
+        dict_dataset = dict()
+        random.seed(self.seed)
+
+        # all pairs draw from the same stream, so items never repeat across pairs
+        items = self.iter_distinct_items()
+        for k in range(num_pairs):
+            lst_union = list(islice(items, self.intersection + self.difference))
+            dict_dataset['A' + str(k)], dict_dataset['B' + str(k)] = self.split_union(lst_union)
 
-        # randomly generate synthetic datasets, recommended
-        while len(lst_union) < self.intersection + self.difference:
-            random_num = random.randint(0, 2 ** 32 - 1)
-            if random_num not in lst_union:
-                lst_union.append(random_num)
+        return dict_dataset
+
+    def generate_synthetic_corpus(self, num_users, num_items, cardinality, skew=2.0):
+        dict_dataset = dict()
+        random.seed(self.seed)
+
+        # set cardinalities follow a pareto distribution with mean cardinality, as in online social networks
+        lst_universe = list(islice(self.iter_distinct_items(), num_items))
+        scale = cardinality * (skew - 1) / skew
+        for user in range(num_users):
+            num_user_items = min(num_items, max(1, int(scale * random.paretovariate(skew))))
+            dict_dataset[user] = random.sample(lst_universe, num_user_items)
+
+        return dict_dataset
+
+    def split_union(self, lst_union):
+        lst_A = list()
+        lst_B = list()
 
         lst_A.extend(lst_union[0:self.intersection])
         lst_A.extend(lst_union[self.intersection:self.intersection + int(self.difference * self.ratio)])
         lst_B.extend(lst_union[0:self.intersection])
         lst_B.extend(lst_union[self.intersection + int(self.difference * self.ratio):])
 
-        dict_dataset['A'] = lst_A
-        dict_dataset['B'] = lst_B
+        return lst_A, lst_B
 
-        return dict_dataset
+    def iter_distinct_items(self):
+        if self.generator == 'permutation':
+            # a seeded bijection of [0, 2 ** 32), so distinct indices always give distinct items
+            key = random.getrandbits(32)
+            for index in range(2 ** 32):
+                yield permute_index(index, key)
+        elif self.generator == 'random':
+            # randomly generate synthetic datasets, the set keeps the rejection of duplicates in constant time
+            set_union = set()
+            while True:
+                random_num = random.randint(0, 2 ** 32 - 1)
+                if random_num not in set_union:
+                    set_union.add(random_num)
+                    yield random_num
+        else:
+            raise ValueError('unknown generator: ' + str(self.generator))
+
+    def iter_edge_chunks(self, start=0, end=None):
+        # start and end have to fall on line boundaries, e.g. the ranges returned by get_line_ranges()
+        with open(self.dataset, 'rb') as freader:
+            freader.seek(start)
+            position = start
+            remainder = b''
+            while end is None or position < end:
+                chunk = freader.read(self.chunk_size if end is None else min(self.chunk_size, end - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+
+                # only complete lines are parsed, the tail of the chunk is carried over to the next one
+                chunk = remainder + chunk
+                end_line = chunk.rfind(b'\n') + 1
+                remainder = chunk[end_line:]
+                yield self.parse_edges(chunk[:end_line], chunk.count(b'\n', 0, end_line))
+
+            if remainder.strip():
+                yield self.parse_edges(remainder, 1)
+
+    def get_line_ranges(self, num_ranges):
+        file_size = os.path.getsize(self.dataset)
+
+        # each boundary is moved forward to the start of the next line
+        lst_offset = [0]
+        with open(self.dataset, 'rb') as freader:
+            for k in range(1, num_ranges):
+                target = file_size * k // num_ranges
+                if target <= lst_offset[-1]:
+                    continue
+                freader.seek(target - 1)
+                freader.readline()
+                offset = freader.tell()
+                if lst_offset[-1] < offset < file_size:
+                    lst_offset.append(offset)
+        lst_offset.append(file_size)
+
+        return list(zip(lst_offset, lst_offset[1:]))
+
+    def parse_edges(self, lines, num_lines):
+        # the tokens of all lines are parsed at once, so every line has to hold exactly one user and one item,
+        # otherwise e.g. a weight column would silently shift the following edges
+        lst_edge = list(map(int, lines.split()))
+        if len(lst_edge) != 2 * num_lines:
+            raise ValueError(self.dataset + ' is not an edge list with two columns (user item) on every line')
+
+        return lst_edge
 
     def load_public_dataset(self):
         dict_dataset = dict()
 
-        with open(self.dataset) as freader:
-            for line in freader:
-                [user, item] = list(map(int, line.strip().split()))
-                if user not in dict_dataset:
-                    dict_dataset[user] = []
-                if item not in dict_dataset[user]:
-                    dict_dataset[user].append(item)
+        # items are collected in insertion-ordered dicts, which deduplicates them in linear time
+        for lst_edge in self.iter_edge_chunks():
+            edges = iter(lst_edge)
+            for user, item in zip(edges, edges):
+                dict_items = dict_dataset.get(user)
+                if dict_items is None:
+                    dict_items = dict_dataset[user] = dict()
+                dict_items[item] = None
+
+        for user in dict_dataset:
+            dict_dataset[user] = list(dict_dataset[user])
 
         return dict_dataset
 
+    def iter_public_dataset(self):
+        # users are yielded one at a time, so the file has to list all edges of a user contiguously
+        set_seen = set()
+        current_user = None
+        dict_items = dict()
+
+        for lst_edge in self.iter_edge_chunks():
+            edges = iter(lst_edge)
+            for user, item in zip(edges, edges):
+                if user != current_user:
+                    if current_user is not None:
+                        yield current_user, list(dict_items)
+                    if user in set_seen:
+                        raise ValueError('dataset is not grouped by user: ' + str(user) + ' appears twice')
+                    set_seen.add(user)
+                    current_user = user
+                    dict_items = dict()
+                dict_items[item] = None
+
+        if current_user is not None:
+            yield current_user, list(dict_items)
+
+    def load_csr_dataset(self):
+        lst_user = list()
+        offsets = array('q', [0])
+        items = array('q')
+
+        for user, lst_items in self.iter_public_dataset():
+            lst_user.append(user)
+            items.extend(lst_items)
+            offsets.append(len(items))
+
+        return CSRDataset(lst_user, offsets, items)
+
+    def get_fingerprint(self):
+        if self.dataset == 'synthetic':
+            return {'dataset': 'synthetic', 'intersection': self.intersection, 'difference': self.difference,
+                    'ratio': self.ratio, 'seed': self.seed, 'generator': self.generator}
+
+        stat = os.stat(self.dataset)
+        return {'dataset': os.path.abspath(self.dataset), 'bytes': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
     def load_dataset(self):
         if self.dataset == 'synthetic':
             dict_dataset = self.generate_synthetic_dataset()
+        elif self.csr:
+            dict_dataset = self.load_csr_dataset()
         else:
             dict_dataset = self.load_public_dataset()
 
-        return dict_dataset
\ No newline at end of file
+        return dict_dataset
+
+
+class CSRDataset(Mapping):
+    '''
+        :param lst_user: users in the order they appear in the dataset
+        :param offsets: items of the k-th user are stored in items[offsets[k]:offsets[k + 1]]
+        :param items: items of all users stored back to back
+
+        :output: a read-only map user->array of items, which can be used wherever dict_dataset is expected
+    '''
+    def __init__(self, lst_user, offsets, items):
+        self.lst_user = lst_user
+        self.offsets = offsets
+        self.items = items
+        self.dict_position = {user: k for k, user in enumerate(lst_user)}
+
+    def __getitem__(self, user):
+        k = self.dict_position[user]
+        return self.items[self.offsets[k]:self.offsets[k + 1]]
+
+    def __iter__(self):
+        return iter(self.lst_user)
+
+    def __len__(self):
+        return len(self.lst_user)
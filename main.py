@@ -1,11 +1,15 @@
 import argparse
 import logging
+import sys
 
 from loader import Dataloader
 from odd import Odd
 from tow import TOW
 from hll import HyperLogLog
 from gxbits import GXBits
+from store import load_or_build_sketch
+from metrics import METRICS
+from planner import get_planner_args, run_planner
 from utils import *
 
 
@@ -16,66 +20,114 @@ def get_args():
     parser.add_argument('--intersection', default=100, type=int, help='set intersection cardinality')
     parser.add_argument('--difference', default=100, type=int, help='set difference cardinality')
     parser.add_argument('--ratio', default=0.5, type=float, help='ratio used to control cardinalities of two sets')
+    parser.add_argument('--generator', default='random', type=str,
+                        help='how synthetic items are drawn: random/permutation')
     parser.add_argument('--exp_rounds', default=1, type=int, help='the number of experimental rounds')
     parser.add_argument('--output', default='result/', type=str, help='output directory')
+    parser.add_argument('--result_format', default='pickle', type=str,
+                        help='format of the result files: pickle/columnar')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='the number of processes used to build sketches and compute exact set differences')
+    parser.add_argument('--ground_truth', default=1, type=int,
+                        help='whether exact set differences are computed or not')
+    parser.add_argument('--csr', default=0, type=int, help='whether public datasets are loaded in CSR format or not')
+    parser.add_argument('--sketch_store', default=None, type=str,
+                        help='directory where sketches are stored and reloaded from across runs')
+    parser.add_argument('--metrics', default=None, type=str,
+                        help='path of the json report of per-phase timers and counters, None disables metrics')
+    parser.add_argument('--profile', default=None, type=str,
+                        help='phase profiled with cProfile: load/hash/build/lookup_table/ground_truth/estimate/results')
+    parser.add_argument('--profile_output', default=None, type=str, help='path of the raw cProfile statistics')
 
     # odd sketch
     parser.add_argument('--odd_size', default=1000, type=int, help='size of odd sketch')
 
     # tug of war sketch
     parser.add_argument('--tow_size', default=1000, type=int, help='size of tug of war sketch')
+    parser.add_argument('--tow_construction', default='classic', type=str,
+                        help='how counter signs are drawn: classic (one hash per counter)/single (few wide hashes)')
 
     # hyperloglog sketch
     parser.add_argument('--hll_size', default=1000, type=int, help='size of hyperloglog sketch')
+    parser.add_argument('--hll_sparse', default=0, type=int,
+                        help='whether hyperloglog sketches with few non-zero counters are stored sparsely or not')
 
     # gxbits sketch
     parser.add_argument('--gxbits_size', default=1000, type=int, help='size of gxbits sketch')
+    parser.add_argument('--gxbits_sparse', default=0, type=int,
+                        help='whether gxbits sketches with few one bits are stored sparsely or not')
     parser.add_argument('--probability', default=0.15, type=float, help='parameter of geometric distribution')
     parser.add_argument('--block_truncated', default=0, type=int, help='whether gxbits sketch is block-truncated or not')
     parser.add_argument('--num_bits', default=2, type=int, help='the number of bits in each segment')
     parser.add_argument('--exp_error', default=0.01, type=float, help='expected error for early stopping')
     parser.add_argument('--rate', default=0.01, type=float, help='iteration rate for newton-raphson method')
+    parser.add_argument('--lookup_table', default=0, type=int,
+                        help='whether gxbits estimates are read from a precomputed table or not')
+    parser.add_argument('--table_dir', default=None, type=str, help='directory used to cache gxbits lookup tables')
+    parser.add_argument('--solver', default='safeguarded', type=str,
+                        help='root finder for gxbits estimates: safeguarded/damped')
+    parser.add_argument('--num_iterations', default=1000, type=int,
+                        help='maximum number of iterations for newton-raphson method')
+    parser.add_argument('--tolerance', default=1e-12, type=float,
+                        help='residual tolerance of the safeguarded newton-raphson method')
 
     args = parser.parse_args()
     return args
 
 
+# 'python main.py plan ...' picks a gxbits configuration instead of running experiments
+if len(sys.argv) > 1 and sys.argv[1] == 'plan':
+    run_planner(get_planner_args(sys.argv[2:]))
+    sys.exit(0)
+
 args = get_args()
+if args.metrics is not None:
+    METRICS.enable(args.profile)
+
 exp_rounds = args.exp_rounds
-lst_all_results = list()
+if args.dataset == 'synthetic':
+    accumulator = RSEAccumulator()
+else:
+    accumulator = AAREAccumulator()
 
 for r in range(exp_rounds):
-    dataloader = Dataloader(args.dataset, args.intersection, args.difference, args.ratio, r)
-    dict_dataset = dataloader.load_dataset()
+    dataloader = Dataloader(args.dataset, args.intersection, args.difference, args.ratio, r, args.csr,
+                            generator=args.generator)
+    with METRICS.timer('load'):
+        dict_dataset = dataloader.load_dataset()
     print('dataset generation finished!')
+    ground_truth = GroundTruth(dict_dataset, args.ground_truth, args.workers)
 
     if args.method == 'odd':
         odd = Odd(dict_dataset, args.odd_size, args.output, r)
-        odd.build_sketch()
-        lst_result = odd.estimate_difference()
-        lst_all_results.extend(lst_result)
+        with METRICS.timer('build'):
+            load_or_build_sketch(odd, args.sketch_store, args.workers, dataloader.get_fingerprint())
+        odd.estimate_difference([accumulator], args.result_format, ground_truth)
     elif args.method == 'tow':
-        tow = TOW(dict_dataset, args.tow_size, args.output, r)
-        tow.build_sketch()
-        lst_result = tow.estimate_difference()
-        lst_all_results.extend(lst_result)
+        tow = TOW(dict_dataset, args.tow_size, args.output, r, construction=args.tow_construction)
+        with METRICS.timer('build'):
+            load_or_build_sketch(tow, args.sketch_store, args.workers, dataloader.get_fingerprint())
+        tow.estimate_difference([accumulator], args.result_format, ground_truth)
     elif args.method == 'hll':
-        hll = HyperLogLog(dict_dataset, args.hll_size, args.output, r)
-        hll.build_sketch()
-        lst_result = hll.estimate_difference()
-        lst_all_results.extend(lst_result)
+        hll = HyperLogLog(dict_dataset, args.hll_size, args.output, r, sparse=args.hll_sparse)
+        with METRICS.timer('build'):
+            load_or_build_sketch(hll, args.sketch_store, args.workers, dataloader.get_fingerprint())
+        hll.estimate_difference([accumulator], args.result_format, ground_truth)
     elif args.method == 'gxbits':
         gxbits = GXBits(dict_dataset, args.gxbits_size, args.probability, args.block_truncated, args.num_bits,
-                        args.exp_error, args.rate, args.output, r)
-        gxbits.build_sketch()
-        lst_result = gxbits.estimate_difference()
-        lst_all_results.extend(lst_result)
+                        args.exp_error, args.rate, args.output, r, args.lookup_table, args.table_dir, args.solver,
+                        args.num_iterations, args.tolerance, sparse=args.gxbits_sparse)
+        with METRICS.timer('build'):
+            load_or_build_sketch(gxbits, args.sketch_store, args.workers, dataloader.get_fingerprint())
+        gxbits.estimate_difference([accumulator], args.result_format, ground_truth)
     else:
         logging.error('Please input the correct method name: odd/tow/hll/gxbits')
 
-if args.dataset == 'synthetic':
-    rse = compute_rse(lst_all_results)
-    print(rse)
-else:
-    aare = compute_aare(lst_all_results)
-    print(aare)
\ No newline at end of file
+if args.ground_truth:
+    print(accumulator.result())
+
+if args.metrics is not None:
+    METRICS.write_report(args.metrics, args=vars(args),
+                         result=accumulator.result() if args.ground_truth else None)
+    if args.profile_output is not None:
+        METRICS.dump_profile(args.profile_output)
\ No newline at end of file
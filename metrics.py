@@ -0,0 +1,117 @@
+import cProfile
+import json
+import pstats
+import time
+from contextlib import contextmanager, nullcontext
+
+
+# context manager returned by Metrics.timer() while metrics are disabled, so a disabled timer costs one attribute check
+NULL_TIMER = nullcontext()
+
+
+class Metrics:
+
+    """
+        :func enable(): start collecting metrics, optionally profiling every run of the phase named profile_phase
+        :func timer(): context manager adding the wall-clock time of a phase to its timer
+        :func count(): add value to a counter, e.g. the number of items hashed or pairs estimated
+        :func observe(): add a list of values to a distribution, e.g. the solver iterations of each estimated pair
+        :func report(): timers, counters, distributions and profile of the run as a json-serializable map
+        :func write_report(): write report() and extra fields (e.g. the arguments of the run) to a json file
+        :func dump_profile(): write the raw cProfile statistics of the profiled phase
+        :func reset(): drop everything collected so far
+
+        :output: one Metrics object, METRICS, is shared by all modules; every call is a no-op until enable() is called,
+                 and phases run in worker processes are not collected
+    """
+
+    def __init__(self):
+        self.enabled = 0
+        self.profile_phase = None
+        self.profiler = None
+        self.reset()
+
+    def enable(self, profile_phase=None):
+        self.enabled = 1
+        self.profile_phase = profile_phase
+        self.profiler = cProfile.Profile() if profile_phase is not None else None
+
+    def reset(self):
+        self.dict_timer = dict()
+        self.dict_counter = dict()
+        self.dict_distribution = dict()
+        if self.profile_phase is not None:
+            self.profiler = cProfile.Profile()
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+
+        return self.time_phase(name)
+
+    @contextmanager
+    def time_phase(self, name):
+        profiler = self.profiler if name == self.profile_phase else None
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            timer = self.dict_timer.setdefault(name, [0.0, 0])
+            timer[0] += elapsed
+            timer[1] += 1
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.dict_counter[name] = self.dict_counter.get(name, 0) + value
+
+    def observe(self, name, lst_value):
+        if not self.enabled:
+            return
+
+        # [number of values, sum, minimum, maximum]
+        distribution = self.dict_distribution.setdefault(name, [0, 0, float('inf'), float('-inf')])
+        for value in lst_value:
+            distribution[0] += 1
+            distribution[1] += value
+            if value < distribution[2]:
+                distribution[2] = value
+            if value > distribution[3]:
+                distribution[3] = value
+
+    def report(self, num_functions=20):
+        report = dict()
+        report['timers'] = {name: {'seconds': seconds, 'calls': calls}
+                            for name, (seconds, calls) in self.dict_timer.items()}
+        report['counters'] = dict(self.dict_counter)
+        report['distributions'] = {name: {'count': num, 'mean': total / num, 'min': minimum, 'max': maximum}
+                                   for name, (num, total, minimum, maximum) in self.dict_distribution.items() if num}
+
+        if self.profiler is not None and self.profile_phase in self.dict_timer:
+            # the num_functions functions with the largest cumulative time in the profiled phase
+            stats = pstats.Stats(self.profiler).stats
+            lst_key = sorted(stats, key=lambda key: stats[key][3], reverse=True)[:num_functions]
+            report['profile'] = {'phase': self.profile_phase, 'functions': [
+                {'function': '{}:{}({})'.format(*key), 'calls': stats[key][1], 'tottime': stats[key][2],
+                 'cumtime': stats[key][3]} for key in lst_key]}
+
+        return report
+
+    def write_report(self, path, **extra):
+        report = dict(extra)
+        report.update(self.report())
+
+        with open(path, 'w') as fwriter:
+            json.dump(report, fwriter, indent=2)
+
+    def dump_profile(self, path):
+        # raw cProfile statistics, readable with pstats or snakeviz
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+
+
+METRICS = Metrics()
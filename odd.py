@@ -1,9 +1,10 @@
-import mmh3
 import random
 import math
-import pickle
-import os
+import heapq
 
+from hashing import hash_user_items
+from parallel import build_sketch_parallel
+from metrics import METRICS
 from utils import *
 
 
@@ -14,62 +15,155 @@ class Odd:
         :param size: the number of bits in each odd sketch
         :param output: output directory, the default is 'result/'
         :param seed: the round number of experiments, which is also used as the random seed in each round
+        :param hash_cache: optional HashCache shared by the sketches built over the same dataset
 
         :func build_sketch(): initialize an odd sketch for each user and update the sketch based on all its items
-        :func estimate_difference(): estimate the set difference cardinality
+                              (each sketch is packed into a python integer, bit j stores the j-th bit)
+                              (users are sharded across a process pool when workers > 1)
+        :func build_sketch_stream(): build the sketches of a stream of (user, list of items) pairs
+        :func build_user_sketch(): build the odd sketch of a single list of items
+        :func merge_sketch(): merge the sketches of two disjoint sets into the sketch of their union (bitwise XOR)
+        :func add(), remove(): insert an item into or delete an item from the set and the sketch of a user
+        :func apply_batch(): apply a stream of (user, item, +1/-1) events to dict_dataset and the sketches, hashing the
+                             changed items of each user together; returns the net insertions and deletions
+        :func pack_sketch(), unpack_sketch(): convert a sketch to and from a fixed-width record of record_size bytes
+        :func get_params(): parameters that determine the content of the sketches, stored in sketch store headers
+        :func estimate_difference(): estimate the set difference cardinality of shuffled adjacent users, updating
+                                     lst_accumulator and writing the results in result_format ('pickle'/'columnar');
+                                     exact differences come from ground_truth, a GroundTruth shared across methods
+        :func estimate_from_bits(): estimate the set difference cardinality from the number of one bits in A XOR B
+        :func estimate_pair(): estimate the set difference cardinality between two odd sketches
+        :func estimate_one_vs_many(): estimate the set difference cardinalities between a query sketch and a list of
+                                      candidate sketches
+        :func estimate_all_pairs(): estimate the matrix of set difference cardinalities within a list of sketches
+        :func top_k(): select the k candidate sketches with the smallest (or largest) estimated set difference
 
         :output format: [actual set difference, estimated set difference]
     """
 
-    def __init__(self, dict_dataset, size, output, seed):
+    def __init__(self, dict_dataset, size, output, seed, hash_cache=None):
+        self.method = 'odd'
         self.dict_dataset = dict_dataset
         self.size = size
+        self.record_size = (size + 7) // 8
         self.output = output
         self.seed = seed
-
-    def build_sketch(self):
+        self.hash_cache = hash_cache
         self.dict_odd_sketch = dict()
 
+    def build_sketch(self, workers=1):
+        if workers > 1:
+            self.dict_odd_sketch = build_sketch_parallel(self, workers)
+            return
+
+        self.dict_odd_sketch = dict()
         for user in self.dict_dataset:
-            odd_sketch = [0] * self.size
+            self.dict_odd_sketch[user] = self.build_user_sketch(self.dict_dataset[user], user)
+
+    def build_sketch_stream(self, stream):
+        # stream yields (user, list of items), e.g. Dataloader.iter_public_dataset(), so sketches can be built without
+        # holding the raw dataset in memory
+        self.dict_odd_sketch = dict()
+        for user, lst_items in stream:
+            self.dict_odd_sketch[user] = self.build_user_sketch(lst_items)
+
+    def build_user_sketch(self, lst_items, user=None):
+        # bit j of the integer is the j-th bit of the odd sketch
+        odd_sketch = 0
+
+        for hash_value in hash_user_items(lst_items, self.seed, self.hash_cache, user, self.dict_dataset):
+            odd_sketch ^= 1 << (hash_value % self.size)
+
+        return odd_sketch
+
+    def add(self, user, item):
+        self.apply_batch([(user, item, '+')])
+
+    def remove(self, user, item):
+        self.apply_batch([(user, item, '-')])
 
-            for item in self.dict_dataset[user]:
-                index = mmh3.hash(str(item), signed=False, seed=self.seed) % self.size
-                odd_sketch[index] ^= 1
+    def apply_batch(self, events):
+        # dict_dataset is updated along with the sketches, and only the items whose membership changed are flipped, so
+        # a duplicate insertion or the deletion of an absent item leaves the sketch as it is; insertions and deletions
+        # flip the same bits, so the changed items of a user collapse into one sketch
+        dict_insert, dict_delete = apply_events(self.dict_dataset, events)
+        for user in set(dict_insert) | set(dict_delete):
+            if self.hash_cache is not None:
+                self.hash_cache.invalidate(self.dict_dataset, user)
+            update_sketch = self.build_user_sketch(dict_insert.get(user, []) + dict_delete.get(user, []))
+            self.dict_odd_sketch[user] = self.merge_sketch(self.dict_odd_sketch.get(user, 0), update_sketch)
+        METRICS.count('events_applied', sum([len(lst_items) for lst_items in dict_insert.values()]) +
+                      sum([len(lst_items) for lst_items in dict_delete.values()]))
 
-            self.dict_odd_sketch[user] = odd_sketch
+        return dict_insert, dict_delete
+
+    def merge_sketch(self, odd_sketch_A, odd_sketch_B):
+        return odd_sketch_A ^ odd_sketch_B
+
+    def pack_sketch(self, odd_sketch):
+        return odd_sketch.to_bytes(self.record_size, 'little')
+
+    def unpack_sketch(self, buffer):
+        return int.from_bytes(buffer, 'little')
+
+    def get_params(self):
+        return {'method': self.method, 'size': self.size, 'seed': self.seed, 'record_size': self.record_size}
+
+    def estimate_difference(self, lst_accumulator=None, result_format='pickle', ground_truth=None):
+        if ground_truth is None:
+            ground_truth = GroundTruth(self.dict_dataset)
 
-    def estimate_difference(self):
         random.seed(self.seed)
 
         lst_user = list(self.dict_dataset.keys())
         num_user = len(lst_user)
         random.shuffle(lst_user)
+        lst_actual = ground_truth.compute_pairs(list(zip(lst_user, lst_user[1:])))
+
+        result_sink = ResultSink(self.output, 'odd_' + str(self.seed), result_format, lst_accumulator)
+        with METRICS.timer('estimate'):
+            for i in range(num_user - 1):
+                user_A = lst_user[i]
+                user_B = lst_user[i + 1]
+
+                odd_sketch_A = self.dict_odd_sketch[user_A]
+                odd_sketch_B = self.dict_odd_sketch[user_B]
+
+                one_bits = popcount(odd_sketch_A ^ odd_sketch_B)
+                estimated_difference = self.estimate_from_bits(one_bits)
+                actual_difference = lst_actual[i]
+                result_sink.append(actual_difference, estimated_difference)
+        METRICS.count('pairs_estimated', num_user - 1)
+
+        return result_sink.close()
 
-        lst_result = list()
-        for i in range(num_user - 1):
-            user_A = lst_user[i]
-            user_B = lst_user[i + 1]
+    def estimate_from_bits(self, one_bits):
+        if one_bits >= self.size / 2:
+            one_bits = self.size / 2 - 1
 
-            lst_A = self.dict_dataset[user_A]
-            lst_B = self.dict_dataset[user_B]
+        return math.log(1 - 2 * one_bits / self.size) / math.log(1 - 2 / self.size)
 
-            odd_sketch_A = self.dict_odd_sketch[user_A]
-            odd_sketch_B = self.dict_odd_sketch[user_B]
+    def estimate_pair(self, odd_sketch_A, odd_sketch_B):
+        return self.estimate_from_bits(popcount(odd_sketch_A ^ odd_sketch_B))
 
-            one_bits = 0
-            for j in range(self.size):
-                one_bits += (odd_sketch_A[j] ^ odd_sketch_B[j])
+    def estimate_one_vs_many(self, odd_sketch, lst_odd_sketch):
+        return [self.estimate_from_bits(popcount(odd_sketch ^ candidate)) for candidate in lst_odd_sketch]
 
-            if one_bits >= self.size / 2:
-                one_bits = self.size / 2 - 1
+    def estimate_all_pairs(self, lst_odd_sketch):
+        num_sketch = len(lst_odd_sketch)
+        diagonal = self.estimate_from_bits(0)
+        matrix = [[diagonal] * num_sketch for _ in range(num_sketch)]
+        for i in range(num_sketch):
+            odd_sketch = lst_odd_sketch[i]
+            for j in range(i + 1, num_sketch):
+                matrix[i][j] = matrix[j][i] = self.estimate_from_bits(popcount(odd_sketch ^ lst_odd_sketch[j]))
 
-            estimated_difference = math.log(1 - 2 * one_bits / self.size) / math.log(1 - 2 / self.size)
-            actual_difference = compute_difference(lst_A, lst_B)
-            lst_result.append([actual_difference, estimated_difference])
+        return matrix
 
-        foutput = open(os.path.join(self.output, 'odd_' + str(self.seed) + '.out'), 'wb')
-        pickle.dump(lst_result, foutput)
-        foutput.close()
+    def top_k(self, odd_sketch, lst_odd_sketch, k, largest=False):
+        # the estimate grows with the number of one bits in A XOR B, so candidates are ranked by their popcount and
+        # only the k selected ones are mapped to estimates; returns [(candidate position, estimated difference)]
+        select = heapq.nlargest if largest else heapq.nsmallest
+        lst_top = select(k, ((popcount(odd_sketch ^ candidate), i) for i, candidate in enumerate(lst_odd_sketch)))
 
-        return lst_result
\ No newline at end of file
+        return [(i, self.estimate_from_bits(one_bits)) for one_bits, i in lst_top]
@@ -0,0 +1,218 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+from array import array
+
+from loader import Dataloader, permute_index
+
+
+# sketch builder shared with the forked workers, so that they inherit the dataset instead of receiving it pickled
+_builder = None
+
+
+def build_shard(lst_user):
+    """
+    :param lst_user: users of one shard
+
+    :output the sketches of all users in the shard, packed back to back as fixed-width records
+    """
+
+    buffer = bytearray()
+    for user in lst_user:
+        buffer += _builder.pack_sketch(_builder.build_user_sketch(_builder.dict_dataset[user], user))
+
+    return bytes(buffer)
+
+
+def build_sketch_parallel(builder, workers, num_shards=None):
+    """
+    :param builder: sketch object providing dict_dataset, record_size, build_user_sketch(), pack_sketch() and
+                    unpack_sketch()
+    :param workers: the number of worker processes
+    :param num_shards: the number of shards users are split into, the default is 4 shards per worker
+
+    :output a map user->sketch identical to the serial build
+    """
+
+    global _builder
+
+    lst_user = list(builder.dict_dataset.keys())
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning('parallel sketch construction requires the fork start method, building serially')
+        return {user: builder.build_user_sketch(builder.dict_dataset[user], user) for user in lst_user}
+
+    if num_shards is None:
+        num_shards = 4 * workers
+    shard_size = max(1, -(-len(lst_user) // num_shards))
+    lst_shard = [lst_user[i:i + shard_size] for i in range(0, len(lst_user), shard_size)]
+
+    _builder = builder
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            lst_buffer = pool.map(build_shard, lst_shard)
+    finally:
+        _builder = None
+
+    dict_sketch = dict()
+    record_size = builder.record_size
+    for shard, buffer in zip(lst_shard, lst_buffer):
+        view = memoryview(buffer)
+        for k, user in enumerate(shard):
+            dict_sketch[user] = builder.unpack_sketch(view[k * record_size:(k + 1) * record_size])
+
+    return dict_sketch
+
+
+def get_partition(item, num_partitions):
+    # items are partitioned by a permutation of their value, so every copy of an edge lands in the same partition and
+    # the partitions of a user are disjoint
+    return permute_index(item & 0xffffffff, 0) % num_partitions
+
+
+def map_edges(task):
+    """
+    :param task: (path of an edge file, start and end of a byte range aligned to lines, the number of partitions,
+                  prefix of the spill files)
+
+    :output the edges of the byte range are routed to their item partition and written to '<prefix>_<partition>' as
+            flat arrays [user, item, ...] of 64-bit integers
+    """
+
+    path, start, end, num_partitions, spill_prefix = task
+    lst_partition = [array('q') for _ in range(num_partitions)]
+    for lst_edge in Dataloader(path, 0, 0, 0, 0).iter_edge_chunks(start, end):
+        edges = iter(lst_edge)
+        for user, item in zip(edges, edges):
+            lst_partition[get_partition(item, num_partitions)].extend((user, item))
+
+    for partition, edges in enumerate(lst_partition):
+        with open(spill_prefix + '_' + str(partition), 'wb') as fwriter:
+            edges.tofile(fwriter)
+
+
+def reduce_partition(lst_spill):
+    """
+    :param lst_spill: spill files of one partition, one per map task
+
+    :output (users, their partial sketches packed back to back as fixed-width records) built from the deduplicated
+            edges of the partition
+    """
+
+    dict_dataset = dict()
+    for spill in lst_spill:
+        edges = array('q')
+        with open(spill, 'rb') as freader:
+            edges.frombytes(freader.read())
+        os.remove(spill)
+
+        edges = iter(edges)
+        for user, item in zip(edges, edges):
+            dict_items = dict_dataset.get(user)
+            if dict_items is None:
+                dict_items = dict_dataset[user] = dict()
+            dict_items[item] = None
+
+    buffer = bytearray()
+    for user in dict_dataset:
+        buffer += _builder.pack_sketch(_builder.build_user_sketch(list(dict_dataset[user])))
+
+    return list(dict_dataset.keys()), bytes(buffer)
+
+
+def merge_sketches(builder, lst_dict_sketch):
+    """
+    :param builder: sketch object providing merge_sketch()
+    :param lst_dict_sketch: maps user->partial sketch built from disjoint subsets of the items of each user, e.g.
+                            loaded from the sketch stores of several machines
+
+    :output a map user->sketch of all the items of each user
+    """
+
+    dict_sketch = dict()
+    for dict_partial in lst_dict_sketch:
+        for user in dict_partial:
+            if user in dict_sketch:
+                dict_sketch[user] = builder.merge_sketch(dict_sketch[user], dict_partial[user])
+            else:
+                dict_sketch[user] = dict_partial[user]
+
+    return dict_sketch
+
+
+def load_edge_files(lst_path):
+    # the union of the edges of all files, deduplicated as in Dataloader.load_public_dataset()
+    dict_dataset = dict()
+    for path in lst_path:
+        for user, lst_items in Dataloader(path, 0, 0, 0, 0).load_public_dataset().items():
+            dict_items = dict_dataset.setdefault(user, dict())
+            for item in lst_items:
+                dict_items[item] = None
+
+    return {user: list(dict_dataset[user]) for user in dict_dataset}
+
+
+def build_sketch_sharded(builder, lst_path, num_partitions, workers=1, num_ranges=None, verify=0):
+    """
+    :param builder: sketch object providing record_size, build_user_sketch(), merge_sketch(), pack_sketch() and
+                    unpack_sketch()
+    :param lst_path: edge files, a user and even an edge may appear in several files
+    :param num_partitions: the number of item partitions
+    :param workers: the number of worker processes
+    :param num_ranges: the number of byte ranges each file is split into, the default is one per worker
+    :param verify: whether the merged sketches are checked against the single-pass build over all edges or not
+                   (this loads all edges in memory and raises RuntimeError on any difference)
+
+    :output a map user->sketch identical to the single-pass build over all edges: every map task parses one byte range
+            of one file and routes its edges to their item partition through spill files, every reduce task builds
+            the partial sketches of one partition, and the partial sketches of each user are merged
+    """
+
+    global _builder
+
+    if num_ranges is None:
+        num_ranges = workers
+    fork = workers > 1 and 'fork' in multiprocessing.get_all_start_methods()
+    if workers > 1 and not fork:
+        logging.warning('parallel sketch construction requires the fork start method, building serially')
+
+    _builder = builder
+    try:
+        with tempfile.TemporaryDirectory() as spill_dir:
+            lst_map_task = list()
+            for path in lst_path:
+                for start, end in Dataloader(path, 0, 0, 0, 0).get_line_ranges(num_ranges):
+                    spill_prefix = os.path.join(spill_dir, 'map' + str(len(lst_map_task)))
+                    lst_map_task.append((path, start, end, num_partitions, spill_prefix))
+            lst_reduce_task = [[task[4] + '_' + str(partition) for task in lst_map_task]
+                               for partition in range(num_partitions)]
+
+            if fork:
+                with multiprocessing.get_context('fork').Pool(workers) as pool:
+                    pool.map(map_edges, lst_map_task)
+                    lst_output = pool.map(reduce_partition, lst_reduce_task)
+            else:
+                for task in lst_map_task:
+                    map_edges(task)
+                lst_output = [reduce_partition(task) for task in lst_reduce_task]
+    finally:
+        _builder = None
+
+    record_size = builder.record_size
+    lst_dict_sketch = list()
+    for lst_user, buffer in lst_output:
+        view = memoryview(buffer)
+        lst_dict_sketch.append({user: builder.unpack_sketch(view[k * record_size:(k + 1) * record_size])
+                                for k, user in enumerate(lst_user)})
+    dict_sketch = merge_sketches(builder, lst_dict_sketch)
+
+    if verify:
+        dict_dataset = load_edge_files(lst_path)
+        if set(dict_sketch) != set(dict_dataset):
+            raise RuntimeError('sharded build and single-pass build cover different users')
+        for user in dict_dataset:
+            if builder.pack_sketch(dict_sketch[user]) != \
+                    builder.pack_sketch(builder.build_user_sketch(dict_dataset[user])):
+                raise RuntimeError('sharded build differs from the single-pass build for user ' + str(user))
+
+    return dict_sketch
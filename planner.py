@@ -0,0 +1,191 @@
+import argparse
+import json
+import math
+import tempfile
+
+from loader import Dataloader
+from gxbits import GXBits
+from utils import *
+
+
+def get_planner_args(argv=None):
+    parser = argparse.ArgumentParser(prog='main.py plan',
+                                     description='smallest gxbits configuration meeting a target relative error')
+    parser.add_argument('--min_difference', default=10, type=float, help='smallest expected set difference cardinality')
+    parser.add_argument('--max_difference', default=10000, type=float,
+                        help='largest expected set difference cardinality')
+    parser.add_argument('--target_error', default=0.1, type=float,
+                        help='target relative standard error over the whole difference range')
+    parser.add_argument('--bit_budget', default=2 ** 16, type=int, help='the maximum number of bits in each sketch')
+    parser.add_argument('--probabilities', type=str,
+                        default='0.0001,0.0002,0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.15,0.2,0.3',
+                        help='comma-separated candidate parameters of geometric distribution')
+    parser.add_argument('--block_truncated', default=0, type=int, help='whether gxbits sketch is block-truncated or not')
+    parser.add_argument('--num_bits', default='2', type=str,
+                        help='comma-separated candidate numbers of bits in each segment (block-truncated only)')
+    parser.add_argument('--num_points', default=16, type=int,
+                        help='the number of difference cardinalities checked in the range')
+    parser.add_argument('--validate', default=0, type=int,
+                        help='whether the plan is checked on synthetic datasets or not')
+    parser.add_argument('--validation_rounds', default=50, type=int, help='the number of rounds of each validation')
+    parser.add_argument('--intersection', default=100, type=int, help='set intersection cardinality of validations')
+    parser.add_argument('--output', default=None, type=str, help='path of the json plan')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def predict_rse(gxbits, difference):
+    """
+    :param gxbits: GXBits object, only its probability table is used
+    :param difference: set difference cardinality
+
+    :output the relative standard error of the estimate predicted by the delta method: bit i of A XOR B is one with
+            probability q_i = (1 - (1 - 2p_i)^d) / 2, and the mean number of one bits moves by
+            slope = sum -log(1 - 2p_i) (1 - 2p_i)^d / 2 per unit of difference
+    """
+
+    variance = 0
+    slope = 0
+    for base, log_base, multiplicity in zip(gxbits.lst_base, gxbits.lst_log_base, gxbits.lst_multiplicity):
+        power = base ** difference
+        variance += multiplicity * (1 - power * power) / 4
+        slope -= multiplicity * log_base * power / 2
+
+    if slope <= 0:
+        return float('inf')
+
+    # sum q_i (1 - q_i) treats the bits as independent, which holds when the number of items of the difference is
+    # itself poisson distributed; the variance that this poisson count adds, difference * slope ** 2, is taken out
+    # since the bits actually share a fixed number of items (without it, the error of a large sketch would never drop
+    # below 1 / sqrt(difference))
+    variance = max(variance - difference * slope * slope, 0)
+
+    return math.sqrt(variance) / slope / difference
+
+
+def get_differences(min_difference, max_difference, num_points):
+    # geometrically spaced, relative errors change with the order of magnitude of the difference
+    if num_points <= 1 or min_difference >= max_difference:
+        return [min_difference]
+
+    ratio = (max_difference / min_difference) ** (1 / (num_points - 1))
+    return [min_difference * ratio ** k for k in range(num_points)]
+
+
+def create_gxbits(size, probability, block_truncated, num_bits, dict_dataset=None, output=None, seed=0):
+    return GXBits(dict_dataset if dict_dataset is not None else dict(), size, probability, block_truncated, num_bits,
+                  0.01, 0.01, output, seed, lookup_table=1)
+
+
+def evaluate_config(size, probability, block_truncated, num_bits, lst_difference):
+    gxbits = create_gxbits(size, probability, block_truncated, num_bits)
+
+    return max([predict_rse(gxbits, difference) for difference in lst_difference])
+
+
+def plan(min_difference, max_difference, target_error, bit_budget, lst_probability, block_truncated=0,
+         lst_num_bits=(2,), num_points=16):
+    """
+    :param min_difference, max_difference: range of the expected set difference cardinalities
+    :param target_error: target relative standard error at every difference of the range
+    :param bit_budget: the maximum number of bits in each sketch
+    :param lst_probability: candidate parameters of the geometric distribution
+    :param block_truncated: whether gxbits sketch is block-truncated or not
+    :param lst_num_bits: candidate numbers of bits in each segment (block-truncated only)
+    :param num_points: the number of difference cardinalities checked in the range
+
+    :output map with the smallest configuration (multiple of 8 bits) whose predicted relative standard error is at
+            most target_error over the whole range, its predicted error at each checked difference, and whether the
+            target was met; when no configuration within bit_budget meets it, the most accurate one at bit_budget
+    """
+
+    lst_difference = get_differences(min_difference, max_difference, num_points)
+    if not block_truncated:
+        lst_num_bits = [lst_num_bits[0]]
+
+    # the smallest configuration meeting the target, and the most accurate one at bit_budget in case none does
+    best_feasible = None
+    best_infeasible = None
+    for probability in lst_probability:
+        for num_bits in lst_num_bits:
+            budget_error = evaluate_config(bit_budget, probability, block_truncated, num_bits, lst_difference)
+            if budget_error > target_error:
+                if best_infeasible is None or budget_error < best_infeasible[2]:
+                    best_infeasible = (0, bit_budget, budget_error, probability, num_bits)
+                continue
+
+            # the error only decreases as bits are added, so the smallest sufficient size is found by bisection
+            lower = 0
+            upper = -(-bit_budget // 8)
+            while upper - lower > 1:
+                middle = (lower + upper) // 2
+                if evaluate_config(8 * middle, probability, block_truncated, num_bits, lst_difference) <= target_error:
+                    upper = middle
+                else:
+                    lower = middle
+            size = min(8 * upper, bit_budget)
+            error = evaluate_config(size, probability, block_truncated, num_bits, lst_difference)
+            if best_feasible is None or (size, error) < best_feasible[1:3]:
+                best_feasible = (1, size, error, probability, num_bits)
+
+    best = best_feasible if best_feasible is not None else best_infeasible
+    feasible, size, error, probability, num_bits = best
+    gxbits = create_gxbits(size, probability, block_truncated, num_bits)
+
+    return {'feasible': bool(feasible), 'size': size, 'probability': probability, 'block_truncated': block_truncated,
+            'num_bits': num_bits, 'bytes': (size + 7) // 8, 'target_error': target_error, 'predicted_error': error,
+            'predictions': [[difference, predict_rse(gxbits, difference)] for difference in lst_difference]}
+
+
+def validate_plan(config, lst_difference, num_rounds, intersection):
+    """
+    :param config: output of plan()
+    :param lst_difference: set difference cardinalities to validate, rounded to integers
+    :param num_rounds: the number of synthetic pairs estimated for each difference
+    :param intersection: set intersection cardinality of the synthetic pairs
+
+    :output list of [difference, predicted relative standard error, measured relative standard error]
+    """
+
+    lst_validation = list()
+    with tempfile.TemporaryDirectory() as output:
+        for difference in lst_difference:
+            difference = max(1, int(round(difference)))
+            accumulator = RSEAccumulator()
+            for r in range(num_rounds):
+                dataloader = Dataloader('synthetic', intersection, difference, 0.5, r)
+                gxbits = create_gxbits(config['size'], config['probability'], config['block_truncated'],
+                                       config['num_bits'], dataloader.load_dataset(), output, r)
+                gxbits.build_sketch()
+                gxbits.estimate_difference([accumulator])
+            lst_validation.append([difference, predict_rse(gxbits, difference), accumulator.result()])
+
+    return lst_validation
+
+
+def run_planner(args):
+    config = plan(args.min_difference, args.max_difference, args.target_error, args.bit_budget,
+                  [float(probability) for probability in args.probabilities.split(',')], args.block_truncated,
+                  [int(num_bits) for num_bits in args.num_bits.split(',')], args.num_points)
+
+    if config['feasible']:
+        print('size={size} probability={probability} num_bits={num_bits} ({bytes} bytes per sketch), '
+              'predicted error {predicted_error:.4f} <= {target_error}'.format(**config))
+    else:
+        print('no configuration within the bit budget meets the target error, the most accurate one is '
+              'size={size} probability={probability} num_bits={num_bits} with predicted error '
+              '{predicted_error:.4f}'.format(**config))
+
+    if args.validate:
+        lst_difference = get_differences(args.min_difference, args.max_difference, min(args.num_points, 3))
+        config['validation'] = validate_plan(config, lst_difference, args.validation_rounds, args.intersection)
+        for difference, predicted_error, measured_error in config['validation']:
+            print('difference={} predicted error {:.4f}, measured error {:.4f}'.format(difference, predicted_error,
+                                                                                       measured_error))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fwriter:
+            json.dump(config, fwriter, indent=2)
+
+    return config
@@ -0,0 +1,405 @@
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+
+from loader import Dataloader
+from odd import Odd
+from tow import TOW
+from hll import HyperLogLog
+from gxbits import GXBits
+from index import SketchIndex
+from store import SketchStore, describe_stores, get_store_path, load_or_build_sketch
+from utils import *
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='local query service over set sketches')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='load sketches and answer queries')
+    serve.add_argument('--method', default='gxbits', type=str, help='method name: odd/tow/hll/gxbits')
+    serve.add_argument('--size', default=1000, type=int, help='sketch size')
+    serve.add_argument('--seed', default=0, type=int, help='seed the sketches were built with')
+    serve.add_argument('--dataset', default=None, type=str,
+                       help='dataset the sketches are built from, None loads them from the sketch store only')
+    serve.add_argument('--csr', default=0, type=int, help='whether public datasets are loaded in CSR format or not')
+    serve.add_argument('--sketch_store', default=None, type=str, help='directory of sketch stores')
+    serve.add_argument('--workers', default=1, type=int, help='the number of processes used to build sketches')
+    serve.add_argument('--probability', default=0.15, type=float, help='parameter of geometric distribution')
+    serve.add_argument('--block_truncated', default=0, type=int, help='whether gxbits sketch is block-truncated or not')
+    serve.add_argument('--num_bits', default=2, type=int, help='the number of bits in each segment')
+    serve.add_argument('--gxbits_sparse', default=0, type=int,
+                       help='whether gxbits sketches with few one bits are stored sparsely or not')
+    serve.add_argument('--hll_sparse', default=0, type=int,
+                       help='whether hyperloglog sketches with few non-zero counters are stored sparsely or not')
+    serve.add_argument('--tow_construction', default='classic', type=str,
+                       help='how counter signs are drawn: classic/single')
+    serve.add_argument('--index', default=0, type=int,
+                       help='the number of bands of a SketchIndex pruning top-k queries (odd/gxbits), '
+                            '0 scans all users')
+    serve.add_argument('--host', default='127.0.0.1', type=str, help='tcp host')
+    serve.add_argument('--port', default=7878, type=int, help='tcp port')
+    serve.add_argument('--unix', default=None, type=str, help='unix socket path, used instead of tcp when given')
+    serve.add_argument('--cache_size', default=100000, type=int, help='the number of pair estimates kept in the lru')
+    serve.add_argument('--max_batch', default=256, type=int, help='the maximum number of pairs estimated together')
+    serve.add_argument('--batch_window', default=0.001, type=float,
+                       help='seconds a pair query waits for other queries to be batched with')
+
+    bench = subparsers.add_parser('bench', help='measure latency and throughput of a running service')
+    bench.add_argument('--host', default='127.0.0.1', type=str, help='tcp host')
+    bench.add_argument('--port', default=7878, type=int, help='tcp port')
+    bench.add_argument('--unix', default=None, type=str, help='unix socket path, used instead of tcp when given')
+    bench.add_argument('--op', default='pair', type=str, help='query type: pair/one_vs_many/topk')
+    bench.add_argument('--concurrency', default=16, type=int, help='the number of concurrent connections')
+    bench.add_argument('--num_requests', default=10000, type=int, help='the total number of requests')
+    bench.add_argument('--num_candidates', default=100, type=int, help='candidates of each one_vs_many query')
+    bench.add_argument('--k', default=10, type=int, help='k of each topk query')
+    bench.add_argument('--seed', default=0, type=int, help='random seed of the queried users')
+    bench.add_argument('--output', default=None, type=str, help='path of the json report')
+
+    args = parser.parse_args()
+    return args
+
+
+def create_sketch(args, dict_dataset):
+    if args.method == 'odd':
+        return Odd(dict_dataset, args.size, None, args.seed)
+    elif args.method == 'tow':
+        return TOW(dict_dataset, args.size, None, args.seed, construction=args.tow_construction)
+    elif args.method == 'hll':
+        return HyperLogLog(dict_dataset, args.size, None, args.seed, sparse=args.hll_sparse)
+    elif args.method == 'gxbits':
+        return GXBits(dict_dataset, args.size, args.probability, args.block_truncated, args.num_bits, 0.01, 0.01,
+                      None, args.seed, lookup_table=1, sparse=args.gxbits_sparse)
+    raise ValueError('unknown method: ' + str(args.method))
+
+
+def load_sketch(args):
+    """
+    :param args: service arguments
+
+    :output sketch object whose sketches are built from args.dataset (through the sketch store when one is given) or
+            loaded from the sketch store alone (without the sets of the users, so they cannot be updated)
+    """
+
+    if args.dataset is not None:
+        dataloader = Dataloader(args.dataset, 0, 0, 0, args.seed, args.csr)
+        sketch = create_sketch(args, dataloader.load_dataset())
+        load_or_build_sketch(sketch, args.sketch_store, args.workers, dataloader.get_fingerprint())
+        return sketch
+
+    if args.sketch_store is None:
+        raise ValueError('either a dataset or a sketch store is required')
+
+    sketch = create_sketch(args, None)
+    path = get_store_path(sketch, args.sketch_store)
+    if not os.path.exists(path):
+        raise ValueError(describe_stores(sketch, args.sketch_store))
+    store = SketchStore(path, sketch).open()
+    setattr(sketch, 'dict_' + sketch.method + '_sketch', store.load())
+    store.close()
+
+    return sketch
+
+
+class SketchService:
+
+    """
+        :param sketch: sketch object holding the served sketches in dict_<method>_sketch
+        :param cache_size: the number of pair estimates kept in the least recently used cache
+        :param max_batch: the maximum number of pair queries estimated together
+        :param batch_window: seconds a pair query waits for other queries before its batch is estimated
+        :param num_bands: the number of bands of a SketchIndex pruning top-k queries (odd/gxbits), 0 scans all users
+
+        :func handle(): answer one request (a json object with an 'op' field)
+        :func estimate_pair(): coalesce a pair query with the concurrent ones and answer it from the batch or the cache
+        :func flush(): estimate all pending pair queries at once
+        :func estimate_pairs(): estimate a list of pairs, sharing the solver work of equal one bit counts (gxbits)
+        :func one_vs_many(): estimate the set difference between a user and a list of candidates
+        :func top_k(): the k users (among candidates, or all users) with the smallest estimated set difference
+        :func update(): apply (user, item, +1/-1) events, deletions are supported by all sketches but hyperloglog
+        :func serve_client(): answer the json-lines requests of one connection, several requests may be in flight
+
+        :request format: {"id": ..., "op": "pair", "a": user, "b": user}
+                         {"id": ..., "op": "one_vs_many", "query": user, "candidates": [user, ...]}
+                         {"id": ..., "op": "topk", "query": user, "k": k, "candidates": [user, ...] (optional)}
+                         {"id": ..., "op": "update", "events": [[user, item, sign], ...]}
+                         {"id": ..., "op": "users", "limit": n}
+                         {"id": ..., "op": "stats"}
+        :response format: {"id": ..., "result": ...} or {"id": ..., "error": message}
+    """
+
+    def __init__(self, sketch, cache_size=100000, max_batch=256, batch_window=0.001, num_bands=0):
+        self.sketch = sketch
+        self.dict_sketch = getattr(sketch, 'dict_' + sketch.method + '_sketch')
+        # the gxbits lookup table is built before serving, so the first estimate does not block the event loop
+        if sketch.method == 'gxbits' and sketch.lookup_table and sketch.lst_lookup_table is None:
+            sketch.build_lookup_table()
+        self.cache_size = cache_size
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        # pair estimate -> (estimate, version of user A, version of user B), updated users get a new version
+        self.cache = OrderedDict()
+        self.dict_version = dict()
+        self.lst_pending = list()
+        self.flush_handle = None
+        self.index = None
+        if num_bands and sketch.method in ('odd', 'gxbits'):
+            self.index = SketchIndex(sketch, num_bands)
+            self.index.build(self.dict_sketch)
+        self.dict_stats = {'requests': 0, 'pairs': 0, 'cache_hits': 0, 'batches': 0, 'updates': 0}
+
+    async def estimate_pair(self, user_A, user_B):
+        key = (user_A, user_B)
+        cached = self.cache.get(key)
+        if cached is not None and cached[1] == self.dict_version.get(user_A, 0) and \
+                cached[2] == self.dict_version.get(user_B, 0):
+            self.cache.move_to_end(key)
+            self.dict_stats['cache_hits'] += 1
+            return cached[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self.lst_pending.append((user_A, user_B, future))
+        if len(self.lst_pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        lst_pending = self.lst_pending
+        self.lst_pending = list()
+        if not lst_pending:
+            return
+
+        self.dict_stats['batches'] += 1
+        self.dict_stats['pairs'] += len(lst_pending)
+        lst_pair = list()
+        for user_A, user_B, future in lst_pending:
+            if user_A not in self.dict_sketch or user_B not in self.dict_sketch:
+                future.set_exception(KeyError('unknown user: ' + str(user_B if user_A in self.dict_sketch else user_A)))
+            else:
+                lst_pair.append((user_A, user_B, future))
+
+        lst_estimate = self.estimate_pairs([(user_A, user_B) for user_A, user_B, future in lst_pair])
+        for (user_A, user_B, future), estimate in zip(lst_pair, lst_estimate):
+            self.cache[(user_A, user_B)] = (estimate, self.dict_version.get(user_A, 0),
+                                            self.dict_version.get(user_B, 0))
+            if not future.done():
+                future.set_result(estimate)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def estimate_pairs(self, lst_pair):
+        sketch = self.sketch
+        if sketch.method == 'gxbits':
+            return sketch.map_estimates([sketch.count_one_bits(self.dict_sketch[user_A], self.dict_sketch[user_B])
+                                         for user_A, user_B in lst_pair])
+        elif sketch.method == 'odd':
+            return [sketch.estimate_from_bits(popcount(self.dict_sketch[user_A] ^ self.dict_sketch[user_B]))
+                    for user_A, user_B in lst_pair]
+
+        return [sketch.estimate_pair(self.dict_sketch[user_A], self.dict_sketch[user_B]) for user_A, user_B in lst_pair]
+
+    def one_vs_many(self, user, lst_candidate):
+        query = self.dict_sketch[user]
+        lst_sketch = [self.dict_sketch[candidate] for candidate in lst_candidate]
+        if self.sketch.method in ('odd', 'gxbits'):
+            return self.sketch.estimate_one_vs_many(query, lst_sketch)
+
+        return [self.sketch.estimate_pair(query, candidate) for candidate in lst_sketch]
+
+    def top_k(self, user, k, lst_candidate=None):
+        query = self.dict_sketch[user]
+        if lst_candidate is None and self.index is not None:
+            return self.index.query_top_k(query, k, user)
+
+        if lst_candidate is None:
+            lst_candidate = [candidate for candidate in self.dict_sketch if candidate != user]
+        if self.sketch.method in ('odd', 'gxbits'):
+            lst_top = self.sketch.top_k(query, [self.dict_sketch[candidate] for candidate in lst_candidate], k)
+            return [(lst_candidate[i], estimate) for i, estimate in lst_top]
+
+        return heapq.nsmallest(k, zip(lst_candidate, self.one_vs_many(user, lst_candidate)),
+                               key=lambda result: result[1])
+
+    def update(self, events):
+        # events are applied to the sets of the users as well, so inserting an item twice or deleting an absent item
+        # changes nothing; sketches loaded from a store alone have no sets to check events against
+        if not isinstance(self.sketch.dict_dataset, dict):
+            raise ValueError('updates require the sets of the users, serve from --dataset without --csr')
+
+        if self.sketch.method in ('odd', 'gxbits'):
+            dict_insert, dict_delete = self.sketch.apply_batch(events)
+        else:
+            # hyperloglog counters only grow, while tow counters are linear in the items, so insertions add and
+            # deletions subtract the counters of the changed items
+            if self.sketch.method == 'hll':
+                for user, item, sign in events:
+                    if sign in (-1, '-'):
+                        raise ValueError('hll sketches do not support deletions')
+            dict_insert, dict_delete = apply_events(self.sketch.dict_dataset, events)
+            for user in dict_insert:
+                update_sketch = self.sketch.build_user_sketch(dict_insert[user])
+                if user in self.dict_sketch:
+                    update_sketch = self.sketch.merge_sketch(self.dict_sketch[user], update_sketch)
+                self.dict_sketch[user] = update_sketch
+            for user in dict_delete:
+                self.dict_sketch[user] = self.sketch.subtract_sketch(self.dict_sketch[user],
+                                                                     self.sketch.build_user_sketch(dict_delete[user]))
+
+        for user in set(dict_insert) | set(dict_delete):
+            self.dict_version[user] = self.dict_version.get(user, 0) + 1
+            if self.index is not None:
+                self.index.add(user, self.dict_sketch[user])
+        self.dict_stats['updates'] += len(events)
+
+        return len(events)
+
+    async def handle(self, request):
+        self.dict_stats['requests'] += 1
+        op = request.get('op')
+        if op == 'pair':
+            return await self.estimate_pair(request['a'], request['b'])
+        elif op == 'one_vs_many':
+            return self.one_vs_many(request['query'], request['candidates'])
+        elif op == 'topk':
+            return self.top_k(request['query'], request.get('k', 10), request.get('candidates'))
+        elif op == 'update':
+            return self.update(request['events'])
+        elif op == 'users':
+            return list(self.dict_sketch)[:request.get('limit', 1000)]
+        elif op == 'stats':
+            return dict(self.dict_stats, users=len(self.dict_sketch), cache=len(self.cache))
+        raise ValueError('unknown op: ' + str(op))
+
+    async def answer(self, request, writer):
+        try:
+            response = {'id': request.get('id'), 'result': await self.handle(request)}
+        except Exception as error:
+            response = {'id': request.get('id'), 'error': repr(error)}
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+
+    async def serve_client(self, reader, writer):
+        set_task = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    writer.write((json.dumps({'id': None, 'error': repr(error)}) + '\n').encode('utf-8'))
+                    continue
+                # requests are answered concurrently, so pair queries of one connection can share a batch
+                task = asyncio.ensure_future(self.answer(request, writer))
+                set_task.add(task)
+                task.add_done_callback(set_task.discard)
+                if writer.transport.get_write_buffer_size() > 2 ** 20:
+                    await writer.drain()
+            if set_task:
+                await asyncio.gather(*set_task)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    sketch = load_sketch(args)
+    service = SketchService(sketch, args.cache_size, args.max_batch, args.batch_window, args.index)
+
+    if args.unix is not None:
+        server = await asyncio.start_unix_server(service.serve_client, path=args.unix)
+    else:
+        server = await asyncio.start_server(service.serve_client, args.host, args.port)
+    print('serving ' + str(len(service.dict_sketch)) + ' ' + sketch.method + ' sketches on ' +
+          (args.unix if args.unix is not None else args.host + ':' + str(args.port)))
+
+    async with server:
+        await server.serve_forever()
+
+
+async def open_connection(args):
+    if args.unix is not None:
+        return await asyncio.open_unix_connection(args.unix)
+
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def request(reader, writer, message):
+    writer.write((json.dumps(message) + '\n').encode('utf-8'))
+    await writer.drain()
+
+    return json.loads(await reader.readline())
+
+
+async def bench(args):
+    """
+    :param args: benchmark arguments
+
+    :output map with the throughput and the p50/p99 latency of num_requests queries sent by concurrency connections,
+            each connection waiting for the answer of a query before sending the next one
+    """
+
+    reader, writer = await open_connection(args)
+    lst_user = (await request(reader, writer, {'id': 0, 'op': 'users', 'limit': 10 ** 6}))['result']
+    writer.close()
+
+    random.seed(args.seed)
+    lst_latency = list()
+    num_error = 0
+
+    async def run_connection(num_requests):
+        nonlocal num_error
+        reader, writer = await open_connection(args)
+        for i in range(num_requests):
+            if args.op == 'pair':
+                message = {'id': i, 'op': 'pair', 'a': random.choice(lst_user), 'b': random.choice(lst_user)}
+            elif args.op == 'one_vs_many':
+                message = {'id': i, 'op': 'one_vs_many', 'query': random.choice(lst_user),
+                           'candidates': random.sample(lst_user, min(args.num_candidates, len(lst_user)))}
+            else:
+                message = {'id': i, 'op': 'topk', 'query': random.choice(lst_user), 'k': args.k}
+            start = time.perf_counter()
+            response = await request(reader, writer, message)
+            lst_latency.append(time.perf_counter() - start)
+            if 'error' in response:
+                num_error += 1
+        writer.close()
+
+    start = time.perf_counter()
+    lst_num_requests = [args.num_requests // args.concurrency + (c < args.num_requests % args.concurrency)
+                        for c in range(args.concurrency)]
+    await asyncio.gather(*[run_connection(num_requests) for num_requests in lst_num_requests])
+    elapsed = time.perf_counter() - start
+
+    lst_latency.sort()
+    return {'op': args.op, 'concurrency': args.concurrency, 'requests': len(lst_latency), 'errors': num_error,
+            'seconds': elapsed, 'throughput': len(lst_latency) / elapsed,
+            'p50_ms': 1000 * lst_latency[len(lst_latency) // 2],
+            'p99_ms': 1000 * lst_latency[min(len(lst_latency) - 1, int(0.99 * len(lst_latency)))]}
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.command == 'serve':
+        asyncio.run(serve(args))
+    else:
+        report = asyncio.run(bench(args))
+        print('{op}: {requests} requests, {throughput:.0f} requests/s, p50 {p50_ms:.3f} ms, p99 {p99_ms:.3f} ms, '
+              '{errors} errors'.format(**report))
+        if args.output is not None:
+            with open(args.output, 'w') as fwriter:
+                json.dump(report, fwriter, indent=2)
@@ -0,0 +1,257 @@
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+
+MAGIC = b'GXSK'
+VERSION = 3
+
+
+def read_store_header(path):
+    """
+    :param path: path of a store file
+
+    :output (sketch parameters, dataset fingerprint, header length) read from the header of the store
+    """
+
+    with open(path, 'rb') as freader:
+        prefix = freader.read(len(MAGIC) + 8)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + ' is not a sketch store')
+        version, header_length = struct.unpack('<II', prefix[len(MAGIC):])
+        if version != VERSION:
+            raise ValueError('unsupported sketch store version: ' + str(version))
+        header = json.loads(freader.read(header_length).decode('utf-8'))
+
+    return header['params'], header['dataset'], header_length
+
+
+class SketchStore:
+
+    """
+        :param path: path of the store file, the user index is kept next to it in '<path>.users'
+        :param sketch: sketch object (Odd, TOW, HyperLogLog or GXBits) whose parameters the stored sketches must match
+
+        :func write(): create the store from a map user->sketch, overwriting any existing store
+        :func append(): add the sketches of new users at the end of the store
+        :func open(): map the store into memory after checking its parameters against the sketch object
+        :func get(): unpack the sketch of a user directly from the mapped records
+        :func get_digest(): digest of the items the stored sketch of a user was built from, None if unknown
+        :func load(): unpack the sketches of all users into a map user->sketch
+        :func close(): release the memory map
+
+        :file format: magic, version and header length, followed by the json-encoded sketch parameters and fingerprint
+                      of the dataset the sketches were built from, padded to a multiple of 8 bytes, followed by
+                      fixed-width records of record_size bytes in user index order; each line of the user index is the
+                      json list [user, digest of the items of the user]
+    """
+
+    def __init__(self, path, sketch):
+        self.path = path
+        self.sketch = sketch
+        self.params = sketch.get_params()
+        self.record_size = sketch.record_size
+        self.dataset = None
+        self.lst_user = list()
+        self.dict_position = dict()
+        self.dict_digest = dict()
+        self.data_offset = None
+        self.mmap = None
+        self.freader = None
+
+    def write(self, dict_sketch, dict_digest=None, dataset=None):
+        self.close()
+        header = json.dumps({'params': self.params, 'dataset': dataset}, sort_keys=True).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        with open(self.path, 'wb') as fwriter:
+            fwriter.write(MAGIC + struct.pack('<II', VERSION, len(header)) + header)
+        with open(self.path + '.users', 'w') as fwriter:
+            pass
+
+        self.dataset = dataset
+        self.lst_user = list()
+        self.dict_position = dict()
+        self.dict_digest = dict()
+        self.data_offset = len(MAGIC) + 8 + len(header)
+        self.append(dict_sketch, dict_digest)
+
+    def append(self, dict_sketch, dict_digest=None):
+        if not os.path.exists(self.path):
+            self.write(dict_sketch, dict_digest)
+            return
+        if self.data_offset is None:
+            self.read_header()
+
+        for user in dict_sketch:
+            if user in self.dict_position:
+                raise ValueError('user ' + str(user) + ' is already in the sketch store')
+
+        self.close()
+        with open(self.path, 'ab') as fwriter:
+            for user in dict_sketch:
+                fwriter.write(self.sketch.pack_sketch(dict_sketch[user]))
+        with open(self.path + '.users', 'a') as fwriter:
+            for user in dict_sketch:
+                digest = dict_digest.get(user) if dict_digest is not None else None
+                fwriter.write(json.dumps([user, digest]) + '\n')
+                self.dict_position[user] = len(self.lst_user)
+                self.lst_user.append(user)
+                self.dict_digest[user] = digest
+
+    def read_header(self):
+        params, self.dataset, header_length = read_store_header(self.path)
+        if params != json.loads(json.dumps(self.params)):
+            raise ValueError('sketch store parameters ' + str(params) + ' do not match ' + str(self.params))
+
+        self.data_offset = len(MAGIC) + 8 + header_length
+        self.lst_user = list()
+        self.dict_digest = dict()
+        with open(self.path + '.users') as freader:
+            for line in freader:
+                user, digest = json.loads(line)
+                self.lst_user.append(user)
+                self.dict_digest[user] = digest
+        self.dict_position = {user: k for k, user in enumerate(self.lst_user)}
+
+    def open(self):
+        self.close()
+        self.read_header()
+
+        self.freader = open(self.path, 'rb')
+        if self.lst_user:
+            self.mmap = mmap.mmap(self.freader.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self
+
+    def get(self, user):
+        if self.mmap is None and self.lst_user:
+            self.open()
+
+        offset = self.data_offset + self.dict_position[user] * self.record_size
+        return self.sketch.unpack_sketch(memoryview(self.mmap)[offset:offset + self.record_size])
+
+    def get_digest(self, user):
+        return self.dict_digest.get(user)
+
+    def load(self):
+        return {user: self.get(user) for user in self.lst_user}
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.freader is not None:
+            self.freader.close()
+            self.freader = None
+
+    def __contains__(self, user):
+        return user in self.dict_position
+
+    def __len__(self):
+        return len(self.lst_user)
+
+
+def get_store_path(sketch, store_dir):
+    # every parameter is part of the file name, so sketches of another size or probability get a store of their own
+    # instead of failing the header check of an existing one
+    params = sketch.get_params()
+    name = '_'.join([sketch.method] + [key + '-' + str(params[key]) for key in sorted(params) if key != 'method'])
+
+    return os.path.join(store_dir, name + '.sketch')
+
+
+def describe_stores(sketch, store_dir):
+    """
+    :param sketch: sketch object whose store is missing
+    :param store_dir: directory of sketch stores
+
+    :output message listing the stores of the same method in store_dir and how their parameters differ from the ones
+            of the sketch object
+    """
+
+    params = json.loads(json.dumps(sketch.get_params()))
+    lst_line = list()
+    for path in sorted(glob.glob(os.path.join(store_dir, sketch.method + '_*.sketch'))):
+        try:
+            stored_params = read_store_header(path)[0]
+        except ValueError as error:
+            lst_line.append(os.path.basename(path) + ': ' + str(error))
+            continue
+        lst_difference = [key + '=' + str(stored_params.get(key)) + ' (requested ' + str(params.get(key)) + ')'
+                          for key in sorted(set(params) | set(stored_params))
+                          if stored_params.get(key) != params.get(key)]
+        lst_line.append(os.path.basename(path) + ': ' + ', '.join(lst_difference))
+
+    message = 'no ' + sketch.method + ' sketch store in ' + store_dir + ' matches the parameters ' + str(params)
+    if not lst_line:
+        return message + ', and no store of this method exists'
+
+    return message + ', the existing stores differ in\n' + '\n'.join(lst_line)
+
+
+def get_items_digest(lst_items):
+    # items are sorted since sketches do not depend on the order of the items
+    return hashlib.blake2b(repr(sorted(lst_items)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def load_or_build_sketch(sketch, store_dir, workers=1, dataset=None, verify=0):
+    """
+    :param sketch: sketch object (Odd, TOW, HyperLogLog or GXBits)
+    :param store_dir: directory of sketch stores, None always builds the sketches from the dataset
+    :param workers: the number of processes used to build sketches
+    :param dataset: fingerprint of sketch.dict_dataset (e.g. Dataloader.get_fingerprint()) recorded in the store header,
+                    None when the dataset cannot be identified
+    :param verify: whether every stored sketch is checked against the items of its user or not
+
+    :output sketch.dict_<method>_sketch is filled from the store of its parameters in store_dir; when the store was
+            built from the same dataset fingerprint, the sketches are loaded as they are (users missing from the store
+            are built and appended); otherwise, or when verify is set, the stored sketches are checked against a digest
+            of the items of each user, users whose items changed are rebuilt, and the store is rewritten with the new
+            fingerprint; the store is created if it does not exist yet
+    """
+
+    if store_dir is None:
+        sketch.build_sketch(workers)
+        return
+
+    attribute = 'dict_' + sketch.method + '_sketch'
+    path = get_store_path(sketch, store_dir)
+    store = SketchStore(path, sketch)
+
+    if not os.path.exists(path):
+        os.makedirs(store_dir, exist_ok=True)
+        sketch.build_sketch(workers)
+        dict_digest = {user: get_items_digest(sketch.dict_dataset[user]) for user in sketch.dict_dataset}
+        store.write(getattr(sketch, attribute), dict_digest, dataset)
+        return
+
+    store.open()
+    if dataset is not None and store.dataset == dataset and not verify:
+        # the store was built from this very dataset, so no item has to be read
+        dict_new = {user: sketch.build_user_sketch(sketch.dict_dataset[user], user)
+                    for user in sketch.dict_dataset if user not in store}
+        if dict_new:
+            store.append(dict_new, {user: get_items_digest(sketch.dict_dataset[user]) for user in dict_new})
+        setattr(sketch, attribute, {user: store.get(user) for user in sketch.dict_dataset})
+        store.close()
+        return
+
+    dict_digest = {user: get_items_digest(sketch.dict_dataset[user]) for user in sketch.dict_dataset}
+    dict_sketch = dict()
+    changed = store.dataset != dataset or len(store) != len(dict_digest)
+    for user in sketch.dict_dataset:
+        if user in store and store.get_digest(user) == dict_digest[user]:
+            dict_sketch[user] = store.get(user)
+        else:
+            dict_sketch[user] = sketch.build_user_sketch(sketch.dict_dataset[user], user)
+            changed = True
+    store.close()
+
+    # users that left the dataset are dropped as well, so the store holds exactly the sketches of the dataset
+    if changed:
+        store.write(dict_sketch, dict_digest, dataset)
+    setattr(sketch, attribute, dict_sketch)
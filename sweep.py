@@ -0,0 +1,243 @@
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import time
+
+from loader import Dataloader
+from odd import Odd
+from tow import TOW
+from hll import HyperLogLog
+from gxbits import GXBits
+from hashing import HashCache
+from utils import *
+
+
+# arguments and datasets shared with the forked workers, so that every dataset is loaded and parsed only once
+_args = None
+_dict_data = None
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='parameter sweeps of the sketch methods on a process pool')
+    parser.add_argument('--methods', default='odd,tow,hll,gxbits', type=str,
+                        help='comma-separated method names: odd/tow/hll/gxbits')
+    parser.add_argument('--sizes', default='1000', type=str, help='comma-separated sketch sizes')
+    parser.add_argument('--probabilities', default='0.15', type=str,
+                        help='comma-separated parameters of geometric distribution (gxbits only)')
+    parser.add_argument('--num_bits', default='2', type=str,
+                        help='comma-separated numbers of bits in each segment (gxbits only)')
+    parser.add_argument('--dataset', default='synthetic', type=str, help='dataset path or synthetic dataset')
+    parser.add_argument('--intersection', default=100, type=int, help='set intersection cardinality')
+    parser.add_argument('--difference', default=100, type=int, help='set difference cardinality')
+    parser.add_argument('--ratio', default=0.5, type=float, help='ratio used to control cardinalities of two sets')
+    parser.add_argument('--generator', default='random', type=str,
+                        help='how synthetic items are drawn: random/permutation')
+    parser.add_argument('--csr', default=0, type=int, help='whether public datasets are loaded in CSR format or not')
+    parser.add_argument('--exp_rounds', default=1, type=int, help='the number of experimental rounds')
+    parser.add_argument('--workers', default=1, type=int, help='the number of processes running configurations')
+    parser.add_argument('--output', default='result/', type=str, help='output directory')
+    parser.add_argument('--result_format', default='pickle', type=str,
+                        help='format of the result files: pickle/columnar')
+    parser.add_argument('--table', default=None, type=str,
+                        help='path of the consolidated csv table, the default is <output>/sweep.csv')
+
+    parser.add_argument('--tow_construction', default='classic', type=str,
+                        help='how counter signs are drawn: classic/single')
+    parser.add_argument('--hll_sparse', default=0, type=int,
+                        help='whether hyperloglog sketches with few non-zero counters are stored sparsely or not')
+    parser.add_argument('--gxbits_sparse', default=0, type=int,
+                        help='whether gxbits sketches with few one bits are stored sparsely or not')
+    parser.add_argument('--block_truncated', default=0, type=int, help='whether gxbits sketch is block-truncated or not')
+    parser.add_argument('--exp_error', default=0.01, type=float, help='expected error for early stopping')
+    parser.add_argument('--rate', default=0.01, type=float, help='iteration rate for newton-raphson method')
+    parser.add_argument('--lookup_table', default=0, type=int,
+                        help='whether gxbits estimates are read from a precomputed table or not')
+    parser.add_argument('--table_dir', default=None, type=str, help='directory used to cache gxbits lookup tables')
+    parser.add_argument('--solver', default='safeguarded', type=str,
+                        help='root finder for gxbits estimates: safeguarded/damped')
+    parser.add_argument('--num_iterations', default=1000, type=int,
+                        help='maximum number of iterations for newton-raphson method')
+    parser.add_argument('--tolerance', default=1e-12, type=float,
+                        help='residual tolerance of the safeguarded newton-raphson method')
+
+    args = parser.parse_args()
+    return args
+
+
+def get_configs(args):
+    """
+    :param args: sweep arguments
+
+    :output list of (method, size, probability, num_bits) covering the grid, probability and num_bits are None for
+            the methods that do not use them so that each of their configurations runs only once
+    """
+
+    lst_config = list()
+    # num_bits only shapes block-truncated sketches, so without block truncation a single value is swept
+    lst_num_bits = args.num_bits.split(',') if args.block_truncated else args.num_bits.split(',')[:1]
+    for method in args.methods.split(','):
+        for size in args.sizes.split(','):
+            if method == 'gxbits':
+                for probability in args.probabilities.split(','):
+                    for num_bits in lst_num_bits:
+                        lst_config.append((method, int(size), float(probability), int(num_bits)))
+            else:
+                lst_config.append((method, int(size), None, None))
+
+    return lst_config
+
+
+def get_config_name(config):
+    method, size, probability, num_bits = config
+    if method == 'gxbits':
+        return method + '_' + str(size) + '_' + str(probability) + '_' + str(num_bits)
+
+    return method + '_' + str(size)
+
+
+def load_data(args):
+    """
+    :param args: sweep arguments
+
+    :output map round->(dataset, GroundTruth, HashCache); synthetic datasets depend on the round, while a public
+            dataset is loaded once and shared by all rounds; one HashCache holds the hash values of every round, so
+            the configurations of all sizes and methods reuse them instead of hashing the dataset again
+    """
+
+    dict_data = dict()
+    hash_cache = HashCache()
+    # odd, hyperloglog and gxbits sketches hash each item once with the round as seed, tug-of-war sketches do not
+    # use the cache
+    cached = any(method in ('odd', 'hll', 'gxbits') for method in args.methods.split(','))
+    for r in range(args.exp_rounds):
+        if args.dataset != 'synthetic' and r > 0:
+            dict_dataset, ground_truth, _ = dict_data[0]
+            if cached:
+                hash_cache.prepare(dict_dataset, r)
+            dict_data[r] = (dict_dataset, ground_truth, hash_cache)
+            continue
+
+        dataloader = Dataloader(args.dataset, args.intersection, args.difference, args.ratio, r, args.csr,
+                                generator=args.generator)
+        dict_dataset = dataloader.load_dataset()
+        ground_truth = GroundTruth(dict_dataset)
+        # the frozensets are built before forking, so all workers share them instead of building their own
+        for user in dict_dataset:
+            ground_truth.prepare(user)
+        # hashed before forking as well
+        if cached:
+            hash_cache.prepare(dict_dataset, r)
+        dict_data[r] = (dict_dataset, ground_truth, hash_cache)
+
+    return dict_data
+
+
+def create_sketch(config, dict_dataset, output, seed, args, hash_cache=None):
+    method, size, probability, num_bits = config
+    if method == 'odd':
+        return Odd(dict_dataset, size, output, seed, hash_cache)
+    elif method == 'tow':
+        return TOW(dict_dataset, size, output, seed, construction=args.tow_construction)
+    elif method == 'hll':
+        return HyperLogLog(dict_dataset, size, output, seed, hash_cache, sparse=args.hll_sparse)
+    elif method == 'gxbits':
+        return GXBits(dict_dataset, size, probability, args.block_truncated, num_bits, args.exp_error, args.rate,
+                      output, seed, args.lookup_table, args.table_dir, args.solver, args.num_iterations,
+                      args.tolerance, hash_cache, sparse=args.gxbits_sparse)
+    raise ValueError('unknown method: ' + str(method))
+
+
+def run_task(task):
+    """
+    :param task: (configuration, round)
+
+    :output (configuration, round, accumulator, build time, estimation time) of one round of one configuration
+    """
+
+    config, r = task
+    dict_dataset, ground_truth, hash_cache = _dict_data[r]
+
+    output = os.path.join(_args.output, get_config_name(config))
+    os.makedirs(output, exist_ok=True)
+    accumulator = RSEAccumulator() if _args.dataset == 'synthetic' else AAREAccumulator()
+    sketch = create_sketch(config, dict_dataset, output, r, _args, hash_cache)
+
+    start = time.perf_counter()
+    sketch.build_sketch()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sketch.estimate_difference([accumulator], _args.result_format, ground_truth)
+    estimate_time = time.perf_counter() - start
+
+    return config, r, accumulator, build_time, estimate_time
+
+
+def run_sweep(args):
+    """
+    :param args: sweep arguments
+
+    :output list of table rows, one per configuration, with the error of all rounds pooled as in main.py
+    """
+
+    global _args, _dict_data
+
+    lst_config = get_configs(args)
+    lst_task = [(config, r) for config in lst_config for r in range(args.exp_rounds)]
+
+    _args = args
+    _dict_data = load_data(args)
+    print('dataset generation finished!')
+    try:
+        if args.workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+                lst_task_result = list(pool.imap_unordered(run_task, lst_task))
+        else:
+            if args.workers > 1:
+                logging.warning('parallel sweeps require the fork start method, running serially')
+            lst_task_result = [run_task(task) for task in lst_task]
+    finally:
+        _args = None
+        _dict_data = None
+
+    dict_row = dict()
+    for config, r, accumulator, build_time, estimate_time in lst_task_result:
+        if config not in dict_row:
+            dict_row[config] = [accumulator, 0, 0.0, 0.0]
+        else:
+            dict_row[config][0].merge(accumulator)
+        dict_row[config][1] += 1
+        dict_row[config][2] += build_time
+        dict_row[config][3] += estimate_time
+
+    lst_row = list()
+    for config in lst_config:
+        accumulator, num_rounds, build_time, estimate_time = dict_row[config]
+        method, size, probability, num_bits = config
+        lst_row.append({'method': method, 'size': size, 'probability': probability, 'num_bits': num_bits,
+                        'rounds': num_rounds, 'metric': 'rse' if args.dataset == 'synthetic' else 'aare',
+                        'error': accumulator.result(), 'build_seconds': build_time, 'estimate_seconds': estimate_time})
+
+    return lst_row
+
+
+def write_table(lst_row, path):
+    with open(path, 'w', newline='') as fwriter:
+        writer = csv.DictWriter(fwriter, fieldnames=list(lst_row[0].keys()))
+        writer.writeheader()
+        writer.writerows(lst_row)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    lst_row = run_sweep(args)
+
+    for row in lst_row:
+        print('{method:<7} size={size:<6} probability={probability!s:<6} num_bits={num_bits!s:<4} '
+              '{metric}={error:.6f} build={build_seconds:.3f}s estimate={estimate_seconds:.3f}s'.format(**row))
+
+    table = args.table if args.table is not None else os.path.join(args.output, 'sweep.csv')
+    os.makedirs(os.path.dirname(table) or '.', exist_ok=True)
+    write_table(lst_row, table)
@@ -1,8 +1,10 @@
-import mmh3
+import operator
 import random
-import os
-import pickle
+from array import array
 
+from hashing import hash_items, hash_item_masks
+from parallel import build_sketch_parallel
+from metrics import METRICS
 from utils import *
 
 
@@ -13,63 +15,150 @@ class TOW:
         :param size: the number of counters in each tug-of-war sketch
         :param output: output directory, the default is 'result/'
         :param seed: the round number of experiments, which is also used as the random seed in each round
+        :param hash_cache: accepted for a uniform interface but not used, the classic construction hashes every item
+                           once per counter and caching those hash values would keep size copies of the dataset
+        :param construction: 'classic' hashes each item once per counter with seeds seed, seed + 1, ..., while 'single'
+                             draws the signs of all counters from the bits of a few 128-bit hashes of the item
 
         :func build_sketch(): initialize a tug-of-war sketch for each user and update the sketch based on all its items
-        :func estimate_difference(): estimate the set difference cardinality
+                              (users are sharded across a process pool when workers > 1)
+        :func build_sketch_stream(): build the sketches of a stream of (user, list of items) pairs
+        :func build_user_sketch(): build the tug-of-war sketch of a single list of items
+                                   (counters are stored in an array of 32-bit signed integers)
+        :func accumulate_signs(): sum the +1/-1 signs encoded by a list of sign masks into a counter array
+        :func merge_sketch(): merge the sketches of two disjoint sets into the sketch of their union (counter sums)
+        :func subtract_sketch(): remove the sketch of a subset from the sketch of a set (counter differences)
+        :func pack_sketch(), unpack_sketch(): convert a sketch to and from a fixed-width record of record_size bytes
+        :func get_params(): parameters that determine the content of the sketches, stored in sketch store headers
+        :func estimate_difference(): estimate the set difference cardinality of shuffled adjacent users, updating
+                                     lst_accumulator and writing the results in result_format ('pickle'/'columnar');
+                                     exact differences come from ground_truth, a GroundTruth shared across methods
+        :func estimate_pair(): estimate the set difference cardinality between two tug-of-war sketches
 
         :output format: [actual set difference, estimated set difference]
     """
 
-    def __init__(self, dict_dataset, size, output, seed):
+    def __init__(self, dict_dataset, size, output, seed, hash_cache=None, construction='classic'):
+        self.method = 'tow'
         self.dict_dataset = dict_dataset
         self.size = size
+        # counters are packed as 32-bit signed integers
+        self.record_size = 4 * size
         self.output = output
         self.seed = seed
+        self.hash_cache = hash_cache
+        self.construction = construction
 
-    def build_sketch(self):
-        self.dict_tow_sketch = dict()
+    def build_sketch(self, workers=1):
+        if workers > 1:
+            self.dict_tow_sketch = build_sketch_parallel(self, workers)
+            return
 
+        self.dict_tow_sketch = dict()
         for user in self.dict_dataset:
-            tow_sketch = [0] * self.size
+            self.dict_tow_sketch[user] = self.build_user_sketch(self.dict_dataset[user], user)
 
-            for item in self.dict_dataset[user]:
-                for i in range(self.size):
-                    random_num = mmh3.hash(str(item), signed=False, seed=i+self.seed) / (2 ** 32 - 1)
-                    if random_num <= 0.5:
-                        tow_sketch[i] += 1
-                    else:
-                        tow_sketch[i] -= 1
-
-            self.dict_tow_sketch[user] = tow_sketch
+    def build_sketch_stream(self, stream):
+        # stream yields (user, list of items), e.g. Dataloader.iter_public_dataset(), so sketches can be built without
+        # holding the raw dataset in memory
+        self.dict_tow_sketch = dict()
+        for user, lst_items in stream:
+            self.dict_tow_sketch[user] = self.build_user_sketch(lst_items)
+
+    def build_user_sketch(self, lst_items, user=None):
+        if self.construction == 'single':
+            return self.accumulate_signs(hash_item_masks(lst_items, self.seed, self.size))
+        elif self.construction != 'classic':
+            raise ValueError('unknown construction: ' + str(self.construction))
+
+        tow_sketch = array('i', [0]) * self.size
+
+        # the i-th counter uses the hash function seeded with i + seed; these size hash arrays per user are not cached,
+        # they would hold size times the dataset in memory
+        for i in range(self.size):
+            for hash_value in hash_items(lst_items, i + self.seed):
+                random_num = hash_value / (2 ** 32 - 1)
+                if random_num <= 0.5:
+                    tow_sketch[i] += 1
+                else:
+                    tow_sketch[i] -= 1
+
+        return tow_sketch
+
+    def accumulate_signs(self, lst_mask):
+        # bit i of a mask set means +1 for counter i, so counter i = 2 * (masks with bit i set) - len(lst_mask);
+        # the per-bit counts are kept as bit planes (plane k holds bit k of every count), so adding one mask is a
+        # ripple-carry over O(log n) integers instead of size separate increments
+        lst_plane = list()
+        for carry in lst_mask:
+            for k in range(len(lst_plane)):
+                plane = lst_plane[k]
+                lst_plane[k] = plane ^ carry
+                carry &= plane
+                if not carry:
+                    break
+            if carry:
+                lst_plane.append(carry)
+
+        tow_sketch = array('i', [-len(lst_mask)]) * self.size
+        for k in range(len(lst_plane)):
+            weight = 2 << k
+            bits = bin(lst_plane[k])[:1:-1]
+            i = bits.find('1')
+            while i != -1:
+                tow_sketch[i] += weight
+                i = bits.find('1', i + 1)
+
+        return tow_sketch
+
+    def merge_sketch(self, tow_sketch_A, tow_sketch_B):
+        return array('i', map(operator.add, tow_sketch_A, tow_sketch_B))
+
+    def subtract_sketch(self, tow_sketch_A, tow_sketch_B):
+        # counters are linear in the items, so deleting a subset of the items subtracts its counters
+        return array('i', map(operator.sub, tow_sketch_A, tow_sketch_B))
+
+    def pack_sketch(self, tow_sketch):
+        return array('i', tow_sketch).tobytes()
+
+    def unpack_sketch(self, buffer):
+        tow_sketch = array('i')
+        tow_sketch.frombytes(buffer)
+        return tow_sketch
+
+    def get_params(self):
+        return {'method': self.method, 'size': self.size, 'seed': self.seed, 'construction': self.construction,
+                'record_size': self.record_size}
+
+    def estimate_difference(self, lst_accumulator=None, result_format='pickle', ground_truth=None):
+        if ground_truth is None:
+            ground_truth = GroundTruth(self.dict_dataset)
 
-    def estimate_difference(self):
         random.seed(self.seed)
 
         lst_user = list(self.dict_dataset.keys())
         num_user = len(lst_user)
         random.shuffle(lst_user)
+        lst_actual = ground_truth.compute_pairs(list(zip(lst_user, lst_user[1:])))
 
-        lst_result = list()
-        for i in range(num_user - 1):
-            user_A = lst_user[i]
-            user_B = lst_user[i + 1]
+        result_sink = ResultSink(self.output, 'tow_' + str(self.seed), result_format, lst_accumulator)
+        with METRICS.timer('estimate'):
+            for i in range(num_user - 1):
+                user_A = lst_user[i]
+                user_B = lst_user[i + 1]
 
-            lst_A = self.dict_dataset[user_A]
-            lst_B = self.dict_dataset[user_B]
+                tow_sketch_A = self.dict_tow_sketch[user_A]
+                tow_sketch_B = self.dict_tow_sketch[user_B]
 
-            tow_sketch_A = self.dict_tow_sketch[user_A]
-            tow_sketch_B = self.dict_tow_sketch[user_B]
+                estimated_difference = self.estimate_pair(tow_sketch_A, tow_sketch_B)
+                actual_difference = lst_actual[i]
 
-            estimated_difference = 0
-            for j in range(self.size):
-                estimated_difference += (tow_sketch_A[j] - tow_sketch_B[j]) ** 2
-            estimated_difference /= self.size
-            actual_difference = compute_difference(lst_A, lst_B)
+                result_sink.append(actual_difference, estimated_difference)
+        METRICS.count('pairs_estimated', num_user - 1)
 
-            lst_result.append([actual_difference, estimated_difference])
+        return result_sink.close()
 
-        foutput = open(os.path.join(self.output, 'tow_' + str(self.seed) + '.out'), 'wb')
-        pickle.dump(lst_result, foutput)
-        foutput.close()
+    def estimate_pair(self, tow_sketch_A, tow_sketch_B):
+        estimated_difference = sum([(a - b) * (a - b) for a, b in zip(tow_sketch_A, tow_sketch_B)])
 
-        return lst_result
\ No newline at end of file
+        return estimated_difference / self.size
@@ -1,3 +1,91 @@
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+from array import array
+
+from metrics import METRICS
+
+
+RESULT_MAGIC = b'GXRS'
+
+
+def popcount(bits):
+    """
+    :param bits: a packed bit array stored as a non-negative integer
+
+    :output the number of one bits in the bit array
+    """
+
+    return bin(bits).count('1')
+
+
+# int.bit_count() is only available since python 3.10
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+
+
+def apply_events(dict_dataset, events):
+    """
+    :param dict_dataset: dataset represented as a map user->list of items, updated in place; the items of an updated
+                         user are turned once into an insertion-ordered dict item->None, which iterates, counts and
+                         tests membership like the list, so every later event of the user takes constant time
+    :param events: iterable of (user, item, sign) update events, sign is +1/'+' (insert) or -1/'-' (delete)
+
+    :output (map user->items inserted, map user->items deleted) holding the net changes of the sets: inserting an item
+            already in the set or deleting an item missing from it is a no-op, and an item inserted and deleted within
+            the same events is not changed at all; users are created by their first insertion
+    """
+
+    # every sign is checked before the dataset is modified
+    events = list(events)
+    for user, item, sign in events:
+        if sign not in (1, -1, '+', '-'):
+            raise ValueError('unknown event sign: ' + str(sign))
+
+    # whether each item touched by the events was in the set of its user before the events
+    dict_initial = dict()
+    set_created = set()
+    for user, item, sign in events:
+        dict_items = dict_dataset.get(user)
+        if not isinstance(dict_items, dict):
+            if dict_items is None:
+                if sign in (-1, '-'):
+                    continue
+                set_created.add(user)
+            dict_items = dict_dataset[user] = dict.fromkeys(dict_items if dict_items is not None else ())
+
+        present = item in dict_items
+        if present == (sign in (1, '+')):
+            continue
+        dict_initial.setdefault(user, dict()).setdefault(item, present)
+        if present:
+            del dict_items[item]
+        else:
+            dict_items[item] = None
+
+    # users whose items were all deleted again within the events are not created
+    for user in set_created:
+        if not dict_dataset[user]:
+            del dict_dataset[user]
+
+    dict_insert = dict()
+    dict_delete = dict()
+    for user in dict_initial:
+        if user not in dict_dataset:
+            continue
+        dict_items = dict_dataset[user]
+        lst_insert = [item for item, present in dict_initial[user].items() if not present and item in dict_items]
+        lst_delete = [item for item, present in dict_initial[user].items() if present and item not in dict_items]
+        if lst_insert:
+            dict_insert[user] = lst_insert
+        if lst_delete:
+            dict_delete[user] = lst_delete
+
+    return dict_insert, dict_delete
+
+
 def compute_difference(lst_A, lst_B):
     """
     :param lst_A: raw set A
@@ -6,13 +94,80 @@ def compute_difference(lst_A, lst_B):
     :output the set difference cardinality between set A and set B
     """
 
-    cardinality_union = len(list(set(lst_A).union(set(lst_B))))
-    cardinality_intersection = len(list(set(lst_A).intersection(set(lst_B))))
-    cardinality_difference = cardinality_union - cardinality_intersection
+    # |A u B| - |A n B| is the size of the symmetric difference, computed with a single set operation
+    cardinality_difference = len(set(lst_A).symmetric_difference(lst_B))
 
     return cardinality_difference
 
 
+# ground truth engine shared with the forked workers of GroundTruth.compute_pairs()
+_ground_truth = None
+
+
+def compute_pair_chunk(lst_pair):
+    return [_ground_truth.difference(user_A, user_B) for user_A, user_B in lst_pair]
+
+
+class GroundTruth:
+
+    """
+        :param dict_dataset: raw dataset represented as a map user->list of items
+        :param enabled: whether exact set differences are computed or not, disabled engines return nan for serving
+                        workloads that do not need the ground truth
+        :param workers: the number of processes used by compute_pairs()
+
+        :func prepare(): convert the items of a user to a frozenset once and cache it
+        :func invalidate(): drop the cached frozenset of a user whose items changed
+        :func difference(): the exact set difference cardinality between two users
+        :func compute_pairs(): the exact set difference cardinalities of a list of (user_A, user_B) pairs
+
+        :output: one engine is meant to be shared by all methods evaluated over the same dataset
+    """
+
+    def __init__(self, dict_dataset, enabled=True, workers=1):
+        self.dict_dataset = dict_dataset
+        self.enabled = enabled
+        self.workers = workers
+        self.dict_prepared = dict()
+
+    def prepare(self, user):
+        prepared = self.dict_prepared.get(user)
+        if prepared is None:
+            prepared = self.dict_prepared[user] = frozenset(self.dict_dataset[user])
+
+        return prepared
+
+    def invalidate(self, user):
+        self.dict_prepared.pop(user, None)
+
+    def difference(self, user_A, user_B):
+        if not self.enabled:
+            return float('nan')
+
+        return len(self.prepare(user_A) ^ self.prepare(user_B))
+
+    def compute_pairs(self, lst_pair):
+        global _ground_truth
+
+        with METRICS.timer('ground_truth'):
+            if not self.enabled:
+                return [float('nan')] * len(lst_pair)
+            if self.workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+                return [self.difference(user_A, user_B) for user_A, user_B in lst_pair]
+
+            chunk_size = max(1, -(-len(lst_pair) // (4 * self.workers)))
+            lst_chunk = [lst_pair[i:i + chunk_size] for i in range(0, len(lst_pair), chunk_size)]
+
+            _ground_truth = self
+            try:
+                with multiprocessing.get_context('fork').Pool(self.workers) as pool:
+                    lst_result = pool.map(compute_pair_chunk, lst_chunk)
+            finally:
+                _ground_truth = None
+
+            return [difference for chunk in lst_result for difference in chunk]
+
+
 def compute_rse(lst):
     rse = 0
     true_cardinality = lst[0][0]
@@ -39,3 +194,179 @@ def compute_aare(lst):
     aare /= num_exp
 
     return aare
+
+
+class RSEAccumulator:
+
+    """
+        :func update(): add the result of one experiment
+        :func result(): the relative standard error of all experiments added so far, equal to compute_rse()
+        :func merge(): add the experiments of another RSEAccumulator, e.g. one filled in a worker process
+
+        :output: incremental version of compute_rse(), the true cardinality is the actual difference of the first result
+    """
+
+    def __init__(self):
+        self.true_cardinality = None
+        self.rse = 0
+        self.num_exp = 0
+
+    def update(self, actual_difference, estimated_difference):
+        if self.true_cardinality is None:
+            self.true_cardinality = actual_difference
+        self.rse += (estimated_difference - self.true_cardinality) ** 2
+        self.num_exp += 1
+
+    def merge(self, accumulator):
+        if self.true_cardinality is None:
+            self.true_cardinality = accumulator.true_cardinality
+        self.rse += accumulator.rse
+        self.num_exp += accumulator.num_exp
+
+    def result(self):
+        return (self.rse / self.num_exp) ** 0.5 / self.true_cardinality
+
+
+class AAREAccumulator:
+
+    """
+        :func update(): add the result of one experiment
+        :func result(): the average absolute relative error of all experiments added so far, equal to compute_aare()
+        :func merge(): add the experiments of another AAREAccumulator, e.g. one filled in a worker process
+
+        :output: incremental version of compute_aare()
+    """
+
+    def __init__(self):
+        self.aare = 0
+        self.num_exp = 0
+
+    def update(self, actual_difference, estimated_difference):
+        if actual_difference > 0:
+            self.aare += abs(actual_difference - estimated_difference) / actual_difference
+            self.num_exp += 1
+
+    def merge(self, accumulator):
+        self.aare += accumulator.aare
+        self.num_exp += accumulator.num_exp
+
+    def result(self):
+        return self.aare / self.num_exp
+
+
+class ResultWriter:
+
+    """
+        :param path: path of the result file
+        :param columns: names of the columns, every column is stored as 64-bit floats
+        :param chunk_size: the maximum number of rows buffered in memory before they are written as one chunk
+
+        :func append(): add one row
+        :func close(): write the buffered rows and close the file
+
+        :file format: magic, number of columns, length and newline-separated column names, followed by chunks
+                      made of the number of rows and then each column stored contiguously
+    """
+
+    def __init__(self, path, columns=('actual', 'estimated'), chunk_size=2 ** 16):
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.lst_column = [array('d') for _ in columns]
+        self.fwriter = open(path, 'wb')
+
+        names = '\n'.join(columns).encode('utf-8')
+        self.fwriter.write(RESULT_MAGIC + struct.pack('<II', len(columns), len(names)) + names)
+
+    def append(self, *row):
+        for column, value in zip(self.lst_column, row):
+            column.append(value)
+        if len(self.lst_column[0]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        num_rows = len(self.lst_column[0])
+        if num_rows == 0:
+            return
+
+        self.fwriter.write(struct.pack('<Q', num_rows))
+        for k in range(len(self.lst_column)):
+            self.fwriter.write(self.lst_column[k].tobytes())
+            self.lst_column[k] = array('d')
+
+    def close(self):
+        self.flush()
+        self.fwriter.close()
+
+
+def read_results(path):
+    """
+    :param path: path of a result file written by ResultWriter
+
+    :output yield, for every chunk of the memory-mapped file, a map column name->array of values
+    """
+
+    with open(path, 'rb') as freader:
+        with mmap.mmap(freader.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[:len(RESULT_MAGIC)] != RESULT_MAGIC:
+                raise ValueError(path + ' is not a result file')
+            offset = len(RESULT_MAGIC)
+            num_columns, names_length = struct.unpack_from('<II', buffer, offset)
+            offset += 8
+            columns = buffer[offset:offset + names_length].decode('utf-8').split('\n')
+            offset += names_length
+
+            while offset < len(buffer):
+                num_rows, = struct.unpack_from('<Q', buffer, offset)
+                offset += 8
+                dict_column = dict()
+                for name in columns:
+                    dict_column[name] = array('d', buffer[offset:offset + 8 * num_rows])
+                    offset += 8 * num_rows
+                yield dict_column
+
+
+class ResultSink:
+
+    """
+        :param output: output directory
+        :param name: file name without extension, e.g. 'gxbits_0'
+        :param result_format: 'pickle' keeps every result in memory and pickles the list to '<name>.out', while
+                              'columnar' streams the results to '<name>.res' with a ResultWriter
+        :param lst_accumulator: accumulators (e.g. RSEAccumulator, AAREAccumulator) updated with every result
+
+        :func append(): record the result of one pair
+        :func close(): write the results and return the list of results ('pickle') or None ('columnar')
+    """
+
+    def __init__(self, output, name, result_format='pickle', lst_accumulator=None):
+        self.result_format = result_format
+        self.lst_accumulator = lst_accumulator if lst_accumulator is not None else list()
+        if result_format == 'pickle':
+            self.path = os.path.join(output, name + '.out')
+            self.lst_result = list()
+        elif result_format == 'columnar':
+            self.path = os.path.join(output, name + '.res')
+            self.writer = ResultWriter(self.path)
+        else:
+            raise ValueError('unknown result format: ' + str(result_format))
+
+    def append(self, actual_difference, estimated_difference):
+        for accumulator in self.lst_accumulator:
+            accumulator.update(actual_difference, estimated_difference)
+
+        if self.result_format == 'pickle':
+            self.lst_result.append([actual_difference, estimated_difference])
+        else:
+            self.writer.append(actual_difference, estimated_difference)
+
+    def close(self):
+        with METRICS.timer('results'):
+            if self.result_format == 'columnar':
+                self.writer.close()
+                return None
+
+            foutput = open(self.path, 'wb')
+            pickle.dump(self.lst_result, foutput)
+            foutput.close()
+
+        return self.lst_result